@@ -0,0 +1,189 @@
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+#Statuses worth retrying. 429/503 also mean we're going too fast (529 is ElevenLabs' "system busy").
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504, 529)
+THROTTLE_STATUSES = (429, 503, 529)
+
+class AdaptiveLimiter:
+    """
+    A semaphore whose limit adapts to the provider: it's halved whenever a request gets throttled, and grows back by one
+    after every increase_after successful requests in a row. A Retry-After pauses all new requests until it's over.
+    Arguments:
+        max_concurrent: The most requests that can run at the same time.
+        min_concurrent: The limit never goes below this.
+        increase_after: How many successes in a row it takes to allow one more concurrent request.
+    """
+    def __init__(self, max_concurrent:int, min_concurrent:int=1, increase_after:int=10):
+        self.max_concurrent = max(1, max_concurrent)
+        self.min_concurrent = max(1, min(min_concurrent, self.max_concurrent))
+        self.increase_after = increase_after
+        self.limit = self.max_concurrent
+        self.in_flight = 0
+        self._successes = 0
+        self._paused_until = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self.in_flight >= self.limit:
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_concurrent:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttle(self, retry_after:Optional[float]=None):
+        with self._condition:
+            now = time.monotonic()
+            self._successes = 0
+            #The requests that were already running when the limit was hit will usually fail too, only count them once.
+            if now - self._last_decrease > 1:
+                self.limit = max(self.min_concurrent, self.limit // 2)
+                self._last_decrease = now
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+def _retry_after(response) -> Optional[float]:
+    if response is None:
+        return None
+    headers = getattr(response, "headers", None) or dict()
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value) if value else None
+        return max(0.0, date.timestamp() - time.time()) if date is not None else None
+
+def _classify(error:Exception) -> tuple[bool, bool, Optional[float]]:
+    #Returns whether the error is worth retrying, whether it means we were throttled, and the Retry-After (if any).
+    #Works for both requests (ElevenLabs) and openai/httpx errors, which both have a response with status_code and headers.
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRY_STATUSES, status in THROTTLE_STATUSES, _retry_after(response)
+    connection_error = isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)) or \
+                       "Connection" in type(error).__name__ or "Timeout" in type(error).__name__
+    return connection_error, False, None
+
+class ProviderClient:
+    """
+    The shared way of calling a provider's API: a pooled HTTP session, an AdaptiveLimiter for concurrency,
+    and retries with jittered exponential backoff (respecting Retry-After).
+    Arguments:
+        name: The provider name, used in the metrics.
+        max_concurrent: The most requests in flight at the same time. The limiter lowers it when throttled.
+        pool_size: How many connections the session keeps open.
+        max_attempts: How many times a request is tried before giving up.
+        base_delay: The backoff before the first retry, in seconds. It doubles every attempt (with jitter).
+        max_delay: The longest backoff between two attempts.
+    """
+    def __init__(self, name:str, max_concurrent:int=4, pool_size:int=10, max_attempts:int=4, base_delay:float=0.5, max_delay:float=20):
+        self.name = name
+        self.limiter = AdaptiveLimiter(max_concurrent)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "throttled": 0, "retries": 0, "failures": 0}
+
+    def call(self, func:Callable, *args, **kwargs):
+        #Runs func (which makes one API request) with a concurrency slot, retrying it if it fails with a retryable error.
+        return self._attempts(lambda: func(*args, **kwargs), release=True)
+
+    def request(self, method:str, url:str, **kwargs) -> requests.Response:
+        #An HTTP request on the pooled session, raising for error statuses.
+        def send():
+            response = self.session.request(method, url, timeout=kwargs.pop("timeout", 30), **kwargs)
+            response.raise_for_status()
+            return response
+        return self.call(send)
+
+    def stream(self, open_func:Callable[[], Iterator]) -> Iterator:
+        """
+        For streamed responses: open_func starts the request and returns an iterator over the response.
+        Only opening the stream is retried (a retry halfway through would repeat what was already yielded),
+        and the concurrency slot is held until the stream is done.
+        """
+        stream = self._attempts(open_func, release=False)
+        try:
+            yield from stream
+        finally:
+            self.limiter.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["in_flight"] = self.limiter.in_flight
+        stats["concurrency_limit"] = self.limiter.limit
+        return stats
+
+    def _count(self, stat:str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _attempts(self, func:Callable, release:bool):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            self._count("requests")
+            try:
+                result = func()
+            except Exception as e:
+                self.limiter.release()
+                retryable, throttled, retry_after = _classify(e)
+                if throttled:
+                    self._count("throttled")
+                    self.limiter.throttle(retry_after)
+                if not retryable or attempt >= self.max_attempts:
+                    self._count("failures")
+                    raise
+                #Full jitter, so requests that failed together don't all come back at the same time.
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, self.max_delay))
+                print(f"{self.name} request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s (attempt {attempt}/{self.max_attempts}).")
+                self._count("retries")
+                time.sleep(delay)
+                continue
+            self.limiter.success()
+            if release:
+                self.limiter.release()
+            return result
@@ -0,0 +1,147 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+class AudioCache:
+    """
+    Content-addressed cache for generated audio.
+    Entries are stored on disk (one file per entry) with LRU eviction once max_bytes is exceeded,
+    and the most recently used ones are also kept in memory.
+    Arguments:
+        directory: Where the audio files are stored.
+        max_bytes: Maximum total size of the files on disk.
+        memory_max_bytes: Maximum total size of the entries kept in memory.
+    """
+    def __init__(self, directory:str, max_bytes:int=500*1024*1024, memory_max_bytes:int=32*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.Lock()
+        self._disk = OrderedDict()      #key -> size, least recently used first
+        self._disk_bytes = 0
+        self._memory = OrderedDict()    #key -> audio bytes, least recently used first
+        self._memory_bytes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bytes_served": 0, "bytes_stored": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(voice_id:str, model_id:str, generation_options:Any, text:str) -> str:
+        if dataclasses.is_dataclass(generation_options):
+            generation_options = {field.name: getattr(generation_options, field.name) for field in dataclasses.fields(generation_options)}
+        normalized_text = " ".join(text.split())
+        key_data = json.dumps([voice_id, model_id, generation_options, normalized_text], sort_keys=True, default=str)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> Optional[bytes]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                data = self._memory[key]
+                self._stats["memory_hits"] += 1
+                self._stats["bytes_served"] += len(data)
+                return data
+            if key not in self._disk:
+                self._stats["misses"] += 1
+                return None
+            self._disk.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            os.utime(path)  #The modification time is what keeps the LRU order across restarts.
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self._stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self._stats["disk_hits"] += 1
+            self._stats["bytes_served"] += len(data)
+            self._remember(key, data)
+        return data
+
+    def put(self, key:str, data:bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._forget(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._stats["stores"] += 1
+            self._stats["bytes_stored"] += len(data)
+            self._remember(key, data)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups > 0 else None
+            stats["entries"] = len(self._disk)
+            stats["disk_bytes"] = self._disk_bytes
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+            return stats
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        entries = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict()
+
+    def _remember(self, key:str, data:bytes):
+        #Adds the entry to the memory tier. Must be called with the lock held.
+        if len(data) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _forget(self, key:str):
+        #Removes the entry from the index (not from disk). Must be called with the lock held.
+        if key in self._disk:
+            self._disk_bytes -= self._disk.pop(key)
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+
+    def _evict(self):
+        #Must be called with the lock held.
+        while self._disk_bytes > self.max_bytes and len(self._disk) > 0:
+            key = next(iter(self._disk))
+            self._forget(key)
+            self._stats["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
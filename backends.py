@@ -0,0 +1,322 @@
+"""
+The services the server depends on, behind small interfaces:
+    - DialogExtractor: Turns a message into a list of {"character", "text"} lines.
+    - SpeechSynthesizer: Turns a line into audio.
+    - AudioSink: Plays (or otherwise consumes) the audio.
+
+The OpenAI/ElevenLabs/speaker implementations are what main.py normally uses. The local ones are deterministic,
+need no API keys or sound device, and have configurable latency, so the server can be run and benchmarked headless.
+"""
+import dataclasses
+import io
+import math
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+import wave
+import zlib
+from typing import Any, Iterator, Optional
+
+from api_clients import ProviderClient
+from pipeline import SpeechDataParser
+from quote_extractor import parse_quotes
+
+class SynthesisResult:
+    def __init__(self, audio:bytes, request_id:str=None, history_item_id:str=None):
+        self.audio = audio
+        self.request_id = request_id
+        self.history_item_id = history_item_id
+
+class DialogExtractor:
+    #Identifies the extractor in the extraction cache key, so results from different models aren't mixed up.
+    model = None
+
+    def stream_dialog(self, text:str, roster, cancelled:threading.Event=None) -> Iterator[dict]:
+        #Yields the lines of dialog in the text, as {"character": name, "text": line}, as soon as each one is available.
+        #Once cancelled is set, it should stop (and stop any request it's waiting on) as soon as possible.
+        raise NotImplementedError
+
+class SpeechSynthesizer:
+    #Both are part of the audio cache key.
+    model_id = None
+    options = None
+
+    def get_voice(self, voice_id:str) -> Any:
+        #Returns whatever synthesize() needs to use the voice, or None if it doesn't exist.
+        raise NotImplementedError
+
+    def synthesize(self, voice:Any, text:str, previous_request_ids:list[str]) -> SynthesisResult:
+        raise NotImplementedError
+
+    def delete_history_item(self, history_item_id:str):
+        pass
+
+    def prewarm(self, voice_ids:list[str]):
+        #Called with the roster's voices whenever it changes, so they're ready before the first request.
+        pass
+
+class AudioSink:
+    def play(self, line:Any, audio:bytes):
+        #Blocks until the audio is done playing.
+        raise NotImplementedError
+
+    def stop(self):
+        #Makes the play() that's running (if any) return right away.
+        pass
+
+#OpenAI/ElevenLabs implementations
+
+class OpenAIExtractor(DialogExtractor):
+    #The provider limits and retries the requests, so the client should be created with max_retries=0.
+    def __init__(self, client, model:str="gpt-4o-mini", provider:ProviderClient=None):
+        self.client = client
+        self.model = model
+        self.provider = provider if provider is not None else ProviderClient("openai")
+
+    def stream_dialog(self, text:str, roster, cancelled:threading.Event=None) -> Iterator[dict]:
+        # Call the openAI API to get the JSON. The prompt and tools are prebuilt by the roster.
+        responses = list()
+        def open_stream():
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=roster.build_messages(text),
+                tools=roster.tools,
+                tool_choice={"type": "function", "function": {"name": "speak"}},
+                stream=True
+            )
+            responses.append(response)
+            return iter(response)
+        stream = self.provider.stream(open_stream)
+
+        # Lines are yielded as soon as they're complete, so synthesis can start while the rest is still being generated.
+        parser = SpeechDataParser()
+        try:
+            for chunk in stream:
+                if cancelled is not None and cancelled.is_set():
+                    return
+                if len(chunk.choices) == 0 or chunk.choices[0].delta.tool_calls is None:
+                    continue
+                for tool_call in chunk.choices[0].delta.tool_calls:
+                    if tool_call.index == 0 and tool_call.function is not None and tool_call.function.arguments:
+                        yield from parser.feed(tool_call.function.arguments)
+        finally:
+            # Closing the response stops the generation, so a cancelled extraction doesn't keep using tokens.
+            stream.close()
+            for response in responses:
+                response.close()
+
+        if parser.buffer == "":
+            print("Got back no calls.")
+
+class ElevenLabsSynthesizer(SpeechSynthesizer):
+    #Voice lookups and history deletions go through the provider's pooled session. Generations go through elevenlabslib
+    #(which doesn't take a session), but still share the provider's concurrency limit and retries.
+    def __init__(self, user, generation_options, provider:ProviderClient=None):
+        self.user = user
+        self.options = generation_options
+        self.model_id = generation_options.model_id
+        self.provider = provider if provider is not None else ProviderClient("elevenlabs")
+        self._voices = dict()
+        self._lock = threading.Lock()
+
+    def get_voice(self, voice_id:str):
+        with self._lock:
+            voice = self._voices.get(voice_id)
+        if voice is None:
+            #Fetched outside the lock, so one slow voice doesn't hold up the others.
+            voice = self._fetch_voice(voice_id)
+            with self._lock:
+                voice = self._voices.setdefault(voice_id, voice)
+        return voice
+
+    def _fetch_voice(self, voice_id:str):
+        #Same as user.get_voice_by_ID, but on the pooled session.
+        from elevenlabslib import Voice
+        from elevenlabslib.helpers import api_endpoint
+        response = self.provider.request("GET", f"{api_endpoint}/voices/{voice_id}", headers=self.user.headers,
+                                         params={"with_settings": True, "show_legacy": True})
+        return Voice.voiceFactory(response.json(), self.user)
+
+    def prewarm(self, voice_ids:list[str]):
+        with self._lock:
+            missing = [voice_id for voice_id in voice_ids if voice_id not in self._voices]
+        if len(missing) > 0:
+            threading.Thread(target=self._fetch_voices, args=(missing,), daemon=True, name="voice-prewarm").start()
+
+    def _fetch_voices(self, voice_ids:list[str]):
+        for voice_id in voice_ids:
+            try:
+                self.get_voice(voice_id)
+            except Exception as e:
+                print(f"Could not prefetch voice {voice_id}: {e}")
+
+    def synthesize(self, voice, text:str, previous_request_ids:list[str]) -> SynthesisResult:
+        from elevenlabslib import StitchingOptions
+        # Request stitching between the lines of the same voice. auto_next_text stands in for the emotion detection
+        # play_dialog_with_stitching used to do, since that needed the whole dialog upfront.
+        stitching_options = StitchingOptions(auto_next_text=True)
+        if len(previous_request_ids) > 0:
+            stitching_options.previous_request_ids = previous_request_ids[-3:]
+        return self.provider.call(self._generate, voice, text, stitching_options)
+
+    def _generate(self, voice, text:str, stitching_options) -> SynthesisResult:
+        audio_future, info_future = voice.generate_audio_v3(text, self.options, stitching_options=stitching_options)
+        audio = audio_future.result()
+        generation_info = info_future.result()
+        return SynthesisResult(audio, generation_info.request_id, generation_info.history_item_id)
+
+    def delete_history_item(self, history_item_id:str):
+        from elevenlabslib.helpers import api_endpoint
+        self.provider.request("DELETE", f"{api_endpoint}/history/{history_item_id}", headers=self.user.headers)
+
+class SpeakerSink(AudioSink):
+    #Plays the audio on the local sound device.
+    def __init__(self, playback_options=None, audio_format="mp3_44100_128"):
+        from elevenlabslib import PlaybackOptions
+        self.playback_options = playback_options if playback_options is not None else PlaybackOptions()
+        self.audio_format = audio_format
+        self._playing = None
+        self._lock = threading.Lock()
+
+    def play(self, line, audio:bytes):
+        from elevenlabslib import play_audio_v2
+        # Played in the background and waited on here, so stop() can abort it.
+        finished = threading.Event()
+        on_end = self.playback_options.onPlaybackEnd
+        def playback_end():
+            on_end()
+            finished.set()
+        stream = play_audio_v2(audio, dataclasses.replace(self.playback_options, runInBackground=True, onPlaybackEnd=playback_end), self.audio_format)
+        with self._lock:
+            self._playing = (stream, finished)
+        finished.wait()
+        with self._lock:
+            self._playing = None
+
+    def stop(self):
+        with self._lock:
+            playing = self._playing
+        if playing is not None:
+            stream, finished = playing
+            stream.abort()
+            finished.set()
+
+#Local implementations
+
+class LocalQuoteExtractor(DialogExtractor):
+    """
+    Extracts everything in quotes with the local quote parser (see quote_extractor.py), whatever its confidence.
+    Deterministic and offline.
+    Arguments:
+        latency: Seconds to wait before the first line, to simulate the LLM round trip.
+        line_latency: Seconds to wait before each following line, to simulate streaming.
+    """
+    model = "local-quotes"
+
+    def __init__(self, latency:float=0, line_latency:float=0):
+        self.latency = latency
+        self.line_latency = line_latency
+
+    def stream_dialog(self, text:str, roster, cancelled:threading.Event=None) -> Iterator[dict]:
+        cancelled = cancelled if cancelled is not None else threading.Event()
+        if len(roster) == 0 or cancelled.wait(self.latency):
+            return
+        for index, line in enumerate(parse_quotes(text, roster).lines):
+            if index > 0 and cancelled.wait(self.line_latency):
+                return
+            yield line
+
+class ToneSynthesizer(SpeechSynthesizer):
+    """
+    Generates a WAV with a tone (a different pitch for every voice) or silence, as long as the line would roughly take to say.
+    Arguments:
+        latency: Seconds to wait before returning, to simulate the API round trip.
+        char_latency: Extra seconds to wait for each character of text.
+        seconds_per_char: How long the audio is per character of text.
+        silent: Generate silence instead of a tone.
+        sample_rate: The sample rate of the WAV.
+    """
+    model_id = "local-tone"
+
+    def __init__(self, latency:float=0, char_latency:float=0, seconds_per_char:float=0.06, silent:bool=False, sample_rate:int=16000):
+        self.latency = latency
+        self.char_latency = char_latency
+        self.seconds_per_char = seconds_per_char
+        self.silent = silent
+        self.sample_rate = sample_rate
+        self.options = {"seconds_per_char": seconds_per_char, "silent": silent, "sample_rate": sample_rate}
+        self._second_cache = dict()
+
+    def get_voice(self, voice_id:str) -> str:
+        return voice_id
+
+    def synthesize(self, voice:str, text:str, previous_request_ids:list[str]) -> SynthesisResult:
+        time.sleep(self.latency + self.char_latency * len(text))
+        sample_count = int(len(text) * self.seconds_per_char * self.sample_rate)
+        one_second = self._one_second(voice)
+        frames = one_second * (sample_count // self.sample_rate) + one_second[:(sample_count % self.sample_rate) * 2]
+        output = io.BytesIO()
+        with wave.open(output, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(frames)
+        return SynthesisResult(output.getvalue(), request_id=str(uuid.uuid4()))
+
+    def _one_second(self, voice:str) -> bytes:
+        #A whole number of cycles fits in a second, so it can be repeated without clicks.
+        if voice not in self._second_cache:
+            if self.silent:
+                samples = [0] * self.sample_rate
+            else:
+                frequency = 220 + zlib.crc32(str(voice).encode("utf-8")) % 440
+                samples = [int(8000 * math.sin(2 * math.pi * frequency * i / self.sample_rate)) for i in range(self.sample_rate)]
+            self._second_cache[voice] = struct.pack(f"<{len(samples)}h", *samples)
+        return self._second_cache[voice]
+
+def audio_duration(audio:bytes) -> Optional[float]:
+    #Duration in seconds for WAV audio, None for anything else.
+    if not audio.startswith(b"RIFF"):
+        return None
+    with wave.open(io.BytesIO(audio), "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
+
+class NullSink(AudioSink):
+    """
+    Discards the audio.
+    Arguments:
+        realtime: Wait for as long as the audio would take to play (WAV only), to simulate a real sound device.
+    """
+    def __init__(self, realtime:bool=False):
+        self.realtime = realtime
+        self._stopped = threading.Event()
+
+    def play(self, line, audio:bytes):
+        if self.realtime:
+            duration = audio_duration(audio)
+            if duration is not None:
+                self._stopped.clear()
+                self._stopped.wait(duration)
+
+    def stop(self):
+        self._stopped.set()
+
+class FileSink(AudioSink):
+    #Writes every line to its own file in the given directory (.wav for WAV audio, .mp3 otherwise).
+    def __init__(self, directory:str):
+        self.directory = directory
+        self._count = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def play(self, line, audio:bytes):
+        with self._lock:
+            self._count += 1
+            count = self._count
+        extension = "wav" if audio.startswith(b"RIFF") else "mp3"
+        character = re.sub(r"[^\w-]", "_", str(getattr(line, "character", "line")))
+        with open(os.path.join(self.directory, f"{count:06d}_{character}.{extension}"), "wb") as fp:
+            fp.write(audio)
@@ -0,0 +1,64 @@
+"""
+Checks parse_quotes against a set of labelled messages (who should say what, and whether the fast path may skip the LLM),
+then times it. Exits with an error if any message is parsed differently than expected.
+Run from the repo root: python benchmarks/bench_quote_extractor.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from quote_extractor import parse_quotes
+from roster import Roster
+
+THRESHOLD = 0.9     #quote_fast_path_threshold in main.py
+
+ALICE = {"Alice": {"gender": "female", "id": "voice-alice"}}
+ALICE_BOB = {"Alice": {"gender": "female", "id": "voice-alice"}, "Bob": {"gender": "male", "id": "voice-bob"}}
+
+#(name, roster, text, expected lines if the fast path should take it, or None if it must go to the LLM)
+CASES = [
+    ("explicit", ALICE_BOB, '"Hi," said Alice. "Hello," Bob replied.', [("Alice", "Hi,"), ("Bob", "Hello,")]),
+    ("script", ALICE_BOB, 'Alice: "Hi."\nBob: "Hello."', [("Alice", "Hi."), ("Bob", "Hello.")]),
+    ("continuation", ALICE_BOB, '"Hi," said Alice. "How are you?"', [("Alice", "Hi,"), ("Alice", "How are you?")]),
+    ("only character", ALICE, '"Hi."', [("Alice", "Hi.")]),
+    ("only character after narration", ALICE, 'She waved. "Hi."', [("Alice", "Hi.")]),
+    ("only character, named", ALICE, 'Alice waved. "Hi."', [("Alice", "Hi.")]),
+    ("pronoun, only character", ALICE, '"Hi," she said. She said, "Bye."', [("Alice", "Hi,"), ("Alice", "Bye.")]),
+    #Someone without a voice is named in the paragraph, the LLM would skip the line.
+    ("voiceless speaker named", ALICE, 'Bob looked at her. "Hi."', None),
+    #A quoted phrase inside the narration isn't dialog.
+    ("scare quotes", ALICE, 'She called it "the thing".', None),
+    ("attributed to someone without a voice", ALICE, '"Hi," said Bob.', None),
+    ("unbalanced", ALICE, '"Hi, said Alice.', None),
+]
+
+def check():
+    failures = 0
+    for name, voice_dict, text, expected in CASES:
+        extraction = parse_quotes(text, Roster(voice_dict))
+        fast = extraction.confidence >= THRESHOLD
+        lines = [(line["character"], line["text"]) for line in extraction.lines]
+        if expected is None:
+            ok = not fast
+        else:
+            ok = fast and lines == expected
+        if not ok:
+            failures += 1
+            print(f"FAIL {name}: confidence {extraction.confidence}, lines {lines}, reasons {extraction.reasons}")
+    print(f"{len(CASES) - failures}/{len(CASES)} cases parsed as expected.")
+    return failures
+
+def main():
+    failures = check()
+    roster = Roster(ALICE_BOB)
+    scene = "\n\n".join(f'The door opened. "Line {index}," said {"Alice" if index % 2 else "Bob"}. "And more."' for index in range(20))
+    for label, text in (("short", '"Hi," said Alice.'), ("scene", scene)):
+        number = 2000
+        seconds = timeit.timeit(lambda: parse_quotes(text, roster), number=number)
+        print(f"{label:>6}: {seconds / number * 1e6:.1f} us per message")
+    if failures > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
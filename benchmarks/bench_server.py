@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark for /generate_extract_audio.
+Starts the Flask app from main.py (without the Qt window) on the local backends, sends it a corpus of messages
+at each concurrency level and polls the jobs until they're done.
+
+Run from the repo root:
+    python benchmarks/bench_server.py --concurrency 1 4 16 --requests 50
+    python benchmarks/bench_server.py --compare benchmarks/results/<previous run>.json
+
+The corpus is either synthetic (short replies, long multi-character scenes, and messages with no dialog)
+or a JSONL file with one {"text": ...} per line.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+ROSTER = {
+    "Alice": {"gender": "female", "id": "voice-alice"},
+    "Bob": {"gender": "male", "id": "voice-bob"},
+    "Carol": {"gender": "female", "id": "voice-carol"},
+    "Dave": {"gender": "male", "id": "voice-dave"},
+    "Narrator": {"gender": "other", "id": "voice-narrator"},
+}
+
+_WORDS = "the a quiet storm over hills river light shadow door window old new small bright dark cold warm road city".split()
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize()
+
+def synthetic_corpus(rng, count):
+    names = [name for name in ROSTER if name != "Narrator"]
+    corpus = []
+    for index in range(count):
+        kind = ("short", "scene", "no_dialog")[index % 3]
+        if kind == "short":
+            text = f'"{_sentence(rng, 8)}," said {rng.choice(names)}.'
+        elif kind == "scene":
+            parts = []
+            for _ in range(rng.randint(8, 16)):
+                parts.append(f'{_sentence(rng, 12)}. "{_sentence(rng, rng.randint(6, 20))}," {rng.choice(names)} said.')
+            text = "\n\n".join(parts)
+        else:
+            text = ". ".join(_sentence(rng, 12) for _ in range(6)) + "."
+        corpus.append({"kind": kind, "text": text})
+    return corpus
+
+def load_corpus(path):
+    corpus = []
+    with open(path, "r", encoding="utf8") as fp:
+        for line in fp:
+            if line.strip():
+                entry = json.loads(line)
+                corpus.append({"kind": entry.get("kind", "recorded"), "text": entry["text"]})
+    return corpus
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return round(ordered[index], 4)
+
+def summarize(values):
+    return {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99),
+            "mean": round(sum(values) / len(values), 4) if values else None}
+
+def start_server(args):
+    #main.py creates its caches in the working directory, so every run starts from a clean one.
+    os.chdir(tempfile.mkdtemp(prefix="gpt_speaker_bench_"))
+    import main
+    from backends import LocalQuoteExtractor, NullSink, ToneSynthesizer
+
+    main.line_gap = args.line_gap
+    main.speaker_change_gap = args.line_gap
+    main.job_workers = args.workers
+    if args.no_quote_fast_path:
+        main.quote_fast_path.threshold = None
+    main.start_services(LocalQuoteExtractor(latency=args.extract_latency, line_latency=args.line_latency),
+                        ToneSynthesizer(latency=args.tts_latency, char_latency=args.tts_char_latency),
+                        NullSink(realtime=args.realtime_playback))
+    main.roster_holder.publish(ROSTER)
+    main.server_threads = args.server_threads
+    server = main.start_server(port=0)
+    return main.stop_server, f"http://127.0.0.1:{server.port}"
+
+def make_unique(text, marker):
+    #The marker goes inside every quote as well as the narration: the audio cache is keyed on the spoken lines,
+    #so a marker only in the narration would leave every level after the first playing from the cache.
+    text = re.sub(r'(["\u201c])([^"\u201c\u201d]+)(["\u201d])', lambda match: f"{match.group(1)}{marker} {match.group(2)}{match.group(3)}", text)
+    return text + f"\n\n(Run marker {marker}.)"
+
+def run_request(session, base_url, text, poll_interval, timeout):
+    start = time.perf_counter()
+    response = session.post(f"{base_url}/generate_extract_audio", json={"text": text}, timeout=timeout)
+    accept_latency = time.perf_counter() - start
+    #A duplicate of a message that's still being spoken gets a 200 with the existing job (with --allow-cache-hits).
+    if response.status_code not in (200, 202) or "job_id" not in response.json():
+        return {"accept_latency": accept_latency, "error": f"HTTP {response.status_code}"}
+    job_id = response.json()["job_id"]
+    deadline = start + timeout
+    while time.perf_counter() < deadline:
+        job = session.get(f"{base_url}/jobs/{job_id}", timeout=timeout).json()
+        if job["state"] == "cancelled":
+            return {"accept_latency": accept_latency, "error": "cancelled"}
+        if job["state"] in ("done", "failed"):
+            return {"accept_latency": accept_latency, "total_latency": job["finished_at"] - job["created_at"],
+                    "time_to_first_audio": job["time_to_first_audio"], "error": job["error"]}
+        time.sleep(poll_interval)
+    return {"accept_latency": accept_latency, "error": "timeout"}
+
+def error_kinds(errors):
+    #Jobs that failed have their own error messages, they're all counted as "failed".
+    kinds = dict()
+    for error in errors:
+        kind = error if error in ("cancelled", "timeout") or error.startswith("HTTP ") else "failed"
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return kinds
+
+def run_level(base_url, corpus, concurrency, request_count, args):
+    import requests
+    sessions = threading.local()
+
+    def task(index):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        text = corpus[index % len(corpus)]["text"]
+        if not args.allow_cache_hits:
+            text = make_unique(text, f"{time.time_ns()}-{index}")
+        return run_request(sessions.session, base_url, text, args.poll_interval, args.timeout)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(task, range(request_count)))
+    elapsed = time.perf_counter() - start
+
+    completed = [result for result in results if result.get("error") is None]
+    return {
+        "concurrency": concurrency,
+        "requests": request_count,
+        "completed": len(completed),
+        "errors": request_count - len(completed),
+        "error_kinds": error_kinds([result["error"] for result in results if result.get("error") is not None]),
+        "elapsed": round(elapsed, 3),
+        "requests_per_second": round(len(completed) / elapsed, 3) if elapsed > 0 else None,
+        "accept_latency": summarize([result["accept_latency"] for result in results]),
+        "time_to_first_audio": summarize([result["time_to_first_audio"] for result in completed if result.get("time_to_first_audio") is not None]),
+        "total_latency": summarize([result["total_latency"] for result in completed]),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def compare(current, previous_path):
+    with open(previous_path, "r", encoding="utf8") as fp:
+        previous = {level["concurrency"]: level for level in json.load(fp)["levels"]}
+    print(f"\nCompared to {previous_path}:")
+    for level in current["levels"]:
+        old = previous.get(level["concurrency"])
+        if old is None:
+            continue
+        for metric in ("time_to_first_audio", "total_latency"):
+            new_p95, old_p95 = level[metric]["p95"], old[metric]["p95"]
+            if new_p95 is not None and old_p95:
+                print(f"  c={level['concurrency']:<3} {metric} p95: {old_p95:.4f}s -> {new_p95:.4f}s ({(new_p95 - old_p95) / old_p95 * 100:+.1f}%)")
+        if level["requests_per_second"] and old["requests_per_second"]:
+            print(f"  c={level['concurrency']:<3} requests/s: {old['requests_per_second']} -> {level['requests_per_second']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=30, help="Requests per concurrency level.")
+    parser.add_argument("--corpus", help="JSONL file with one {\"text\": ...} per line. Synthetic if omitted.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-threads", type=int, default=8, help="HTTP request threads (server_threads in main.py).")
+    parser.add_argument("--workers", type=int, default=2, help="Job worker threads (job_workers in main.py).")
+    parser.add_argument("--extract-latency", type=float, default=0.8, help="Simulated LLM latency before the first line, in seconds.")
+    parser.add_argument("--line-latency", type=float, default=0.05, help="Simulated streaming delay between extracted lines.")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="Simulated TTS latency per line.")
+    parser.add_argument("--tts-char-latency", type=float, default=0.002, help="Extra simulated TTS latency per character.")
+    parser.add_argument("--no-quote-fast-path", action="store_true", help="Send every message to the (simulated) LLM.")
+    parser.add_argument("--realtime-playback", action="store_true", help="Wait for the audio duration when 'playing' it.")
+    parser.add_argument("--line-gap", type=float, default=0.0, help="Pause between lines during playback.")
+    parser.add_argument("--allow-cache-hits", action="store_true", help="Don't make every request unique, so repeated messages hit the caches.")
+    parser.add_argument("--poll-interval", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="Where to save the JSON results. Defaults to benchmarks/results/bench_server_<timestamp>.json")
+    parser.add_argument("--compare", help="A previous results file to compare against.")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's own output.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(rng, 30)
+    output = args.output or os.path.join(REPO_DIR, "benchmarks", "results", f"bench_server_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    output = os.path.abspath(output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    report = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+        logging.getLogger("waitress").setLevel(logging.ERROR)
+    stop_server, base_url = start_server(args)
+    results = {"timestamp": time.time(), "config": vars(args), "corpus_size": len(corpus), "levels": []}
+    try:
+        for concurrency in args.concurrency:
+            level = run_level(base_url, corpus, concurrency, args.requests, args)
+            results["levels"].append(level)
+            print(f"c={concurrency:<3} {level['requests_per_second']} req/s, "
+                  f"TTFA p50/p95/p99 {level['time_to_first_audio']['p50']}/{level['time_to_first_audio']['p95']}/{level['time_to_first_audio']['p99']}s, "
+                  f"total p50/p95/p99 {level['total_latency']['p50']}/{level['total_latency']['p95']}/{level['total_latency']['p99']}s, "
+                  f"errors {level['errors']}{' ' + str(level['error_kinds']) if level['errors'] else ''}, peak RSS {level['peak_rss_mb']} MB", file=report, flush=True)
+    finally:
+        stop_server()
+        sys.stdout = report
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf8") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results saved to {output}")
+    if compare_path is not None:
+        compare(results, compare_path)
+
+if __name__ == "__main__":
+    main()
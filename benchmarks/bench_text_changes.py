@@ -0,0 +1,51 @@
+"""
+Compares the compiled TextChanges matcher with the old replace() loop.
+Run from the repo root: python benchmarks/bench_text_changes.py
+"""
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from text_changes import TextChanges
+
+def old_apply(text, changes):
+    for key, value in changes.items():
+        text = text.replace(key, value)
+    return text
+
+def make_changes(count, rng):
+    changes = dict()
+    while len(changes) < count:
+        key = "".join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(2, 6)))
+        changes[key] = ".".join(key) + "."
+    return changes
+
+def make_text(changes, rng, words=60):
+    keys = list(changes.keys())
+    filler = ["the", "quick", "brown", "fox", "said", "hello", "to", "everyone", "in", "town"]
+    return " ".join(rng.choice(keys) if rng.random() < 0.1 else rng.choice(filler) for _ in range(words))
+
+def main():
+    rng = random.Random(42)
+    print(f"{'entries':>8} {'old loop (us)':>14} {'compiled (us)':>14} {'speedup':>8} {'compile (ms)':>13}")
+    for count in (10, 1000, 10000):
+        changes = make_changes(count, rng)
+        text = make_text(changes, rng)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "text_changes.json")
+            with open(path, "w", encoding="utf8") as fp:
+                json.dump(changes, fp)
+            compile_time = timeit.timeit(lambda: TextChanges(path), number=1)
+            matcher = TextChanges(path, check_interval=3600)
+            runs = 200 if count < 10000 else 20
+            old_time = timeit.timeit(lambda: old_apply(text, changes), number=runs) / runs
+            new_time = timeit.timeit(lambda: matcher.apply(text), number=runs) / runs
+        print(f"{count:>8} {old_time*1e6:>14.1f} {new_time*1e6:>14.1f} {old_time/new_time:>7.1f}x {compile_time*1e3:>13.1f}")
+
+if __name__ == "__main__":
+    main()
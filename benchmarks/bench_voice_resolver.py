@@ -0,0 +1,73 @@
+"""
+Compares Roster.resolve with the old fuzzywuzzy scan over the whole roster.
+Run from the repo root: python benchmarks/bench_voice_resolver.py
+"""
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from roster import Roster
+
+def make_roster(count, rng):
+    voice_dict = dict()
+    while len(voice_dict) < count:
+        name = " ".join("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8))).capitalize() for _ in range(rng.randint(1, 2)))
+        voice_dict[name] = {"gender": rng.choice(["female", "male", "other"]), "id": f"voice{len(voice_dict)}"}
+    return voice_dict
+
+def make_queries(names, rng, count=200):
+    #Mostly exact names (like the tool schema enforces), with some case changes and typos mixed in.
+    queries = []
+    for _ in range(count):
+        name = rng.choice(names)
+        roll = rng.random()
+        if roll < 0.8:
+            queries.append(name)
+        elif roll < 0.9:
+            queries.append(name.upper())
+        else:
+            position = rng.randrange(len(name))
+            queries.append(name[:position] + rng.choice(string.ascii_lowercase) + name[position + 1:])
+    return queries
+
+def old_resolve(character, voice_dict):
+    from fuzzywuzzy import process
+    matches = process.extract(character, list(voice_dict.keys()), limit=None)
+    return matches[0][0]
+
+def main():
+    rng = random.Random(42)
+    try:
+        import fuzzywuzzy
+    except ImportError:
+        fuzzywuzzy = None
+        print("fuzzywuzzy is not installed, skipping the old implementation.")
+
+    print(f"{'roster':>7} {'fuzzywuzzy (us)':>16} {'cold (us)':>10} {'memoized (us)':>14} {'build (ms)':>11}")
+    for count in (5, 100, 1000):
+        voice_dict = make_roster(count, rng)
+        queries = make_queries(list(voice_dict.keys()), rng)
+
+        build_time = timeit.timeit(lambda: Roster(voice_dict), number=1)
+        cold_time = 0
+        for query in queries:
+            roster = Roster(voice_dict)
+            cold_time += timeit.timeit(lambda: roster.resolve(query), number=1)
+        cold_time /= len(queries)
+        roster = Roster(voice_dict)
+        for query in queries:
+            roster.resolve(query)
+        warm_time = timeit.timeit(lambda: [roster.resolve(query) for query in queries], number=20) / (20 * len(queries))
+
+        old_time = None
+        if fuzzywuzzy is not None:
+            old_queries = queries[:50] if count >= 1000 else queries
+            old_time = timeit.timeit(lambda: [old_resolve(query, voice_dict) for query in old_queries], number=1) / len(old_queries)
+        old_text = f"{old_time*1e6:>16.1f}" if old_time is not None else f"{'-':>16}"
+        print(f"{count:>7} {old_text} {cold_time*1e6:>10.1f} {warm_time*1e6:>14.2f} {build_time*1e3:>11.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from backends import DialogExtractor
+
+_PARAGRAPH_REGEX = re.compile(r"[^\n]+(?:\n|$)|\n")
+_SCENE_BREAK_REGEX = re.compile(r"^\s*(?:\*\s*){3,}$|^\s*(?:-\s*){3,}$|^\s*(?:#\s*){1,3}$|^\s*(?:~\s*){3,}$")
+_SENTENCE_END_REGEX = re.compile(r"[.!?…][\"”’)]*\s+")
+
+class Chunk:
+    """
+    A piece of a long message.
+    Arguments:
+        context: The end of the previous chunk, given to the extractor so it knows who was speaking. Its dialog is not kept.
+        body: The text this chunk is responsible for.
+    """
+    def __init__(self, context:str, body:str):
+        self.context = context
+        self.body = body
+
+    @property
+    def text(self) -> str:
+        return f"{self.context}\n{self.body}" if self.context else self.body
+
+def _split_long_paragraph(paragraph:str, max_chars:int) -> list[str]:
+    #Splits at sentence ends that aren't inside a quote, so a line of dialog is never cut in half.
+    pieces = list()
+    start = 0
+    last_cut = None
+    for match in _SENTENCE_END_REGEX.finditer(paragraph):
+        if (paragraph.count('"', start, match.end()) % 2 == 0 and
+                paragraph.count("“", start, match.end()) == paragraph.count("”", start, match.end())):
+            if match.end() - start > max_chars and last_cut is not None:
+                pieces.append(paragraph[start:last_cut])
+                start = last_cut
+            last_cut = match.end()
+    pieces.append(paragraph[start:])
+    return pieces
+
+def split_text(text:str, max_chars:int, overlap_chars:int=0) -> list[Chunk]:
+    """
+    Splits the text into chunks of up to max_chars (unless a single sentence is longer), at paragraph boundaries.
+    Scene breaks (***, ---, #) are preferred when there's one in the second half of the chunk.
+    Each chunk after the first gets the last paragraphs of the previous one (up to overlap_chars) as context.
+    """
+    paragraphs = list()
+    for paragraph in _PARAGRAPH_REGEX.findall(text):
+        paragraphs.extend(_split_long_paragraph(paragraph, max_chars) if len(paragraph) > max_chars else [paragraph])
+
+    bodies = list()
+    current = list()
+    current_length = 0
+    for paragraph in paragraphs:
+        if current_length + len(paragraph) > max_chars and current_length > 0:
+            cut = len(current)
+            for index in range(len(current) - 1, 0, -1):
+                if _SCENE_BREAK_REGEX.match(current[index]) and sum(len(part) for part in current[:index]) >= max_chars / 2:
+                    cut = index
+                    break
+            bodies.append(current[:cut])
+            current = current[cut:]
+            current_length = sum(len(part) for part in current)
+        current.append(paragraph)
+        current_length += len(paragraph)
+    if len(current) > 0:
+        bodies.append(current)
+
+    chunks = list()
+    previous = None
+    for body in bodies:
+        context = list()
+        if previous is not None:
+            for paragraph in reversed(previous):
+                if sum(len(part) for part in context) + len(paragraph) > overlap_chars:
+                    break
+                context.insert(0, paragraph)
+        chunks.append(Chunk("".join(context).strip(), "".join(body).strip()))
+        previous = body
+    return [chunk for chunk in chunks if chunk.body != ""]
+
+def _normalized(text:str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+class ChunkedExtractor(DialogExtractor):
+    """
+    Extracts the dialog of long messages in chunks, several at a time, instead of in one huge request.
+    Lines are yielded in document order: the first chunk streams as usual, and the later ones are buffered until it's their turn.
+    Arguments:
+        extractor: The DialogExtractor that handles each chunk.
+        chunk_chars: Messages longer than this are split into chunks of about this size.
+        overlap_chars: How much of the previous chunk is included as context.
+        max_parallel: How many chunks of the same message are extracted at the same time.
+    """
+    def __init__(self, extractor:DialogExtractor, chunk_chars:int=6000, overlap_chars:int=400, max_parallel:int=4):
+        self.extractor = extractor
+        self.model = extractor.model
+        self.chunk_chars = chunk_chars
+        self.overlap_chars = overlap_chars
+        self.max_parallel = max_parallel
+
+    def stream_dialog(self, text:str, roster, cancelled:threading.Event=None) -> Iterator[dict]:
+        if self.chunk_chars is None or len(text) <= self.chunk_chars:
+            yield from self.extractor.stream_dialog(text, roster, cancelled)
+            return
+
+        chunks = split_text(text, self.chunk_chars, self.overlap_chars)
+        print(f"Extracting {len(chunks)} chunks.")
+        results = [queue.Queue() for _ in chunks]
+        executor = ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="extract-chunk")
+        for chunk, result in zip(chunks, results):
+            executor.submit(self._extract_chunk, chunk, roster, result, cancelled)
+        try:
+            last_line = None
+            for chunk, result in zip(chunks, results):
+                context, body = _normalized(chunk.context), _normalized(chunk.body)
+                seam_line = last_line
+                while True:
+                    item = result.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    # The context is only there to help with attribution, its lines belong to the previous chunk.
+                    line = _normalized(str(item.get("text", "")))
+                    if line != "" and line in context and line not in body:
+                        continue
+                    # A quote right at the seam can come back from both chunks.
+                    if seam_line is not None and (item.get("character"), line) == seam_line:
+                        seam_line = None
+                        continue
+                    seam_line = None
+                    last_line = (item.get("character"), line)
+                    yield item
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _extract_chunk(self, chunk:Chunk, roster, result:queue.Queue, cancelled:threading.Event=None):
+        try:
+            for item in self.extractor.stream_dialog(chunk.text, roster, cancelled):
+                result.put(item)
+            result.put(None)
+        except Exception as e:
+            result.put(e)
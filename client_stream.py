@@ -0,0 +1,72 @@
+import base64
+import json
+import queue
+import time
+from typing import Iterator
+
+from pipeline import Player
+
+class ClientStream:
+    """
+    Sends the audio of one job back to the client that asked for it, instead of playing it on this machine.
+    Every line is sent as soon as it's ready (in dialog order), as one JSON object per line of the response (NDJSON),
+    with its audio base64 encoded. The client handles the playback, including the gaps between lines.
+    Arguments:
+        line_gap, speaker_change_gap: The gaps the client should leave between lines, sent along with each line.
+        keepalive: Seconds between pings while nothing else is sent, so the connection isn't dropped as idle.
+    """
+    def __init__(self, line_gap:float=0.5, speaker_change_gap:float=0.5, keepalive:float=10):
+        self.keepalive = keepalive
+        self.closed = False
+        self.sent_bytes = 0
+        self._events = queue.Queue()
+        self._gap = 0
+        #The player doesn't wait for anything: lines are handed over as fast as they're synthesized, the client buffers them.
+        self.player = Player(self._send_line, line_gap=line_gap, speaker_change_gap=speaker_change_gap, gap_func=self._set_gap)
+
+    def _set_gap(self, seconds:float):
+        self._gap = seconds
+
+    def _send_line(self, line, audio:bytes):
+        if self.closed:
+            return
+        self._events.put({
+            "type": "line",
+            "index": line.index,
+            "character": line.character,
+            "text": line.text,
+            "gap": self._gap,
+            "mime": "audio/wav" if audio.startswith(b"RIFF") else "audio/mpeg",
+            "audio": base64.b64encode(audio).decode("ascii")
+        })
+        self._gap = 0
+
+    def finish(self, job):
+        #Called once the job is done (or failed). Every line was already handed over by then.
+        self._events.put({"type": "done", "job_id": job.id, "state": job.state, "message": job.message, "error": job.error})
+        self.player.stop()
+
+    def close(self):
+        #The client went away, the remaining lines are dropped.
+        self.closed = True
+
+    def events(self, job) -> Iterator[bytes]:
+        #The response body. Starts with the job ID and ends after the done event. If the client goes away before that, the job is cancelled.
+        try:
+            yield self._encode({"type": "job", "job_id": job.id, "status_url": f"/jobs/{job.id}"})
+            while True:
+                try:
+                    event = self._events.get(timeout=self.keepalive)
+                except queue.Empty:
+                    event = {"type": "ping", "time": time.time()}
+                yield self._encode(event)
+                if event["type"] == "done":
+                    return
+        finally:
+            self.close()
+            job.cancel()
+
+    def _encode(self, event:dict) -> bytes:
+        data = (json.dumps(event) + "\n").encode("utf-8")
+        self.sent_bytes += len(data)
+        return data
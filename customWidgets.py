@@ -1,8 +1,10 @@
-from typing import List
+from __future__ import annotations
+from typing import List, TYPE_CHECKING
 
 import keyring
 from PyQt6 import QtWidgets, QtCore, QtGui
-from elevenlabslib import User, Voice
+if TYPE_CHECKING:
+    from elevenlabslib import User, Voice
 
 import helper
 
@@ -130,6 +132,34 @@ class LabeledInput(QtWidgets.QWidget):
             if infoIsDir:
                 self.info_button.clicked.connect(self.select_file)
 
+    def set_items(self, data):
+        #Replaces the comboBox options, keeping the current selection. If it's not in the new options it's re-added, like in set_value.
+        current_value = self.combo_box.currentData()
+        current_label = self.combo_box.currentText()
+        self.combo_box.blockSignals(True)
+        self.combo_box.clear()
+        for item in data:
+            if isinstance(item, str):
+                item = helper.ComboBoxItem(item, item)
+            self.combo_box.addItem(item.label, item.value)
+        index = self.combo_box.findData(current_value)
+        if index == -1 and current_value is not None:
+            self.combo_box.addItem(current_label or str(current_value), current_value)
+            index = self.combo_box.count() - 1
+        self.combo_box.setCurrentIndex(max(index, 0))
+        self.combo_box.blockSignals(False)
+
+    def set_value(self, value, label=None):
+        #Selects the comboBox item with the given value. If there isn't one, it's added (with the given label) so the value isn't lost.
+        if self.line_edit is not None:
+            self.line_edit.setText("" if value is None else str(value))
+            return
+        index = self.combo_box.findData(value)
+        if index == -1:
+            self.combo_box.addItem(str(label if label is not None else value), value)
+            index = self.combo_box.count() - 1
+        self.combo_box.setCurrentIndex(index)
+
     def select_file(self):
         self.line_edit.setText(str(QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory")))
 
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+class ExtractionCache:
+    """
+    Caches the dialog extracted from a message, so re-playing it doesn't need another LLM call.
+    Entries are persisted to a JSON file, expire after ttl seconds, and the least recently used ones are dropped past max_entries.
+    Arguments:
+        path: The JSON file the entries are saved to.
+        ttl: How many seconds an entry stays valid.
+        max_entries: The maximum number of entries to keep.
+    """
+    def __init__(self, path:str, ttl:float=7*24*3600, max_entries:int=2000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "evictions": 0}
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf8") as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError):
+                print(f"Could not read the extraction cache at {path}, starting from scratch.")
+        self._drop_expired()
+
+    @staticmethod
+    def make_key(text:str, roster_fingerprint:str, model:str, prompt_version:int) -> str:
+        #The roster fingerprint only covers names and genders, since the voice IDs don't matter for the extraction.
+        key_data = json.dumps([text, roster_fingerprint, model, prompt_version])
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if time.time() - entry["created"] > self.ttl:
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            entry["last_used"] = time.time()
+            self._stats["hits"] += 1
+            return entry["speech_data"]
+
+    def put(self, key:str, speech_data:list):
+        with self._lock:
+            now = time.time()
+            self._entries[key] = {"created": now, "last_used": now, "speech_data": speech_data}
+            self._stats["stores"] += 1
+            if len(self._entries) > self.max_entries:
+                by_last_use = sorted(self._entries, key=lambda entry_key: self._entries[entry_key]["last_used"])
+                for evicted_key in by_last_use[:len(self._entries) - self.max_entries]:
+                    del self._entries[evicted_key]
+                    self._stats["evictions"] += 1
+            self._save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups > 0 else None
+            stats["entries"] = len(self._entries)
+            return stats
+
+    def _drop_expired(self):
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if now - entry["created"] > self.ttl]:
+            del self._entries[key]
+
+    def _save(self):
+        #Must be called with the lock held.
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf8") as fp:
+            json.dump(self._entries, fp)
+        os.replace(temp_path, self.path)
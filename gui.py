@@ -0,0 +1,235 @@
+"""
+The Qt windows: the API keys dialog, and the voice picker (which edits the roster file).
+Only imported when running with the GUI, so headless instances never load PyQt6.
+"""
+import os
+import threading
+import typing
+
+from PyQt6 import QtGui
+from PyQt6.QtCore import QEvent, QMetaObject, Qt, Q_ARG, pyqtSignal
+from PyQt6.QtGui import QIcon, QFont
+from PyQt6.QtWidgets import (QApplication, QVBoxLayout, QWidget, QPushButton, QScrollArea, QSizePolicy, QHBoxLayout, QLayout, QSystemTrayIcon, QMenu, QDialog, QMainWindow, QLabel)
+
+import helper
+from customWidgets import LabeledInput, gen_voice_picker
+from roster_file import RosterFile
+from startup_profile import StartupProfile
+
+logo_path = os.path.join("resources","logo.png")
+
+class AskKeys(QDialog):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("API Keys Input")
+        self.main_layout = QVBoxLayout()
+        self.elevenlabs_api_key = LabeledInput(label="Elevenlabs API Key", configKey="elevenlabs_api_key", protected=True)
+        self.openai_api_key = LabeledInput(label="OpenAI API Key", configKey="openai_api_key", protected=True)
+        self.elevenlabs_model = LabeledInput(label="TTS Model", configKey="elevenlabs_model", protected=False, data="eleven_multilingual_v2")
+        self.main_layout.addWidget(self.elevenlabs_api_key)
+        self.main_layout.addWidget(self.openai_api_key)
+        self.main_layout.addWidget(self.elevenlabs_model)
+
+        self.done_button = QPushButton("Done")
+        self.done_button.clicked.connect(lambda: self.done(0))
+        self.main_layout.addWidget(self.done_button)
+        self.setLayout(self.main_layout)
+    def closeEvent(self, a0: typing.Optional[QtGui.QCloseEvent]) -> None:
+        self.done(-1)
+
+class VoicePickerUI(QMainWindow):
+    #Yes, I generated a lot of the UI code with GPT-4 because I'm lazy.
+    #The roster editor: every change is saved to the roster file, which is what the server (or a headless instance) uses.
+    voices_refreshed = pyqtSignal(list)
+    roster_changed = pyqtSignal(dict)
+
+    def __init__(self, user, roster_file:RosterFile, voice_list_file:str, on_stop=None, startup_profile:StartupProfile=None):
+        super().__init__()
+        self.user = user
+        self.roster_file = roster_file
+        self.voice_list_file = voice_list_file
+        self.on_stop = on_stop if on_stop is not None else (lambda: None)
+        self.startup_profile = startup_profile
+        self._loading = False
+        self.setWindowTitle("GPT Speaker")
+        self.initUI()
+
+    def initUI(self):
+        #Use the saved voice list so the window doesn't wait for the API, the real one replaces it once it's fetched.
+        self.voice_list = helper.load_voice_list(self.voice_list_file)
+        self.voices_refreshed.connect(self.set_voice_list)
+        threading.Thread(target=self.refresh_voices, daemon=True).start()
+        self.main_widget = QWidget(self)
+        self.main_layout = QVBoxLayout(self.main_widget)
+        self.main_layout.setSizeConstraint(QLayout.SizeConstraint.SetNoConstraint)
+
+        self.scroll_area = QScrollArea(self.main_widget)
+        self.scroll_area.setWidgetResizable(True)
+        self.scroll_area.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+
+        self.container = QWidget(self.scroll_area)
+        self.scroll_area.setWidget(self.container)
+        self.container_layout = QVBoxLayout(self.container)
+        button_container = QHBoxLayout()
+        self.button_add = QPushButton('Add')
+        self.button_remove = QPushButton('Remove')
+        self.button_stop = QPushButton('Stop speaking')
+        button_container.addWidget(self.button_add)
+        button_container.addWidget(self.button_remove)
+        button_container.addWidget(self.button_stop)
+        self.button_add.clicked.connect(self.add_voice_picker)
+        self.button_remove.clicked.connect(self.remove_widget)
+        self.button_stop.clicked.connect(lambda: self.on_stop())
+
+        self.main_layout.addWidget(self.scroll_area)
+        self.main_layout.addLayout(button_container)
+        self.last_lines = QLabel("")
+        self.last_lines.setFont(QFont('Arial', 12))
+        self.last_lines.setWordWrap(True)
+        self.main_layout.addWidget(self.last_lines)
+
+        self.count = 0
+        self.pickers = list()
+        wrapper_widget = QWidget()
+        wrapper_widget.setLayout(self.main_layout)
+        self.setCentralWidget(wrapper_widget)
+
+
+        #System icon setup
+        self.trayIcon = QSystemTrayIcon(self)
+        self.trayIcon.setIcon(QIcon(logo_path))
+
+        # Create a menu for the tray icon
+        trayMenu = QMenu()
+        restoreAction = trayMenu.addAction("Restore")
+        restoreAction.triggered.connect(self.showNormal)
+        stopAction = trayMenu.addAction("Stop speaking")
+        stopAction.triggered.connect(lambda: self.on_stop())
+        exitAction = trayMenu.addAction("Exit")
+        exitAction.triggered.connect(self.close)
+
+        self.trayIcon.setContextMenu(trayMenu)
+        self.trayIcon.activated.connect(self.onTrayIconActivated)
+
+        #Start from the roster file, and follow it if it's edited while the window is open.
+        self.set_roster(self.roster_file.holder.current.to_dict())
+        self.roster_changed.connect(self.on_roster_changed)
+        self.roster_file.holder.add_listener(lambda roster: self.roster_changed.emit(roster.to_dict()))
+
+
+    def closeEvent(self, event):
+        self.trayIcon.hide()
+        QApplication.instance().exit(0)
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.Type.WindowStateChange:
+            if self.isMinimized():
+                self.hide()
+                self.trayIcon.show()
+                event.ignore()
+
+    def onTrayIconActivated(self, reason):
+        if reason == QSystemTrayIcon.ActivationReason.DoubleClick:
+            self.showNormal()
+
+
+    def add_voice_picker(self):
+        new_container = QHBoxLayout()
+
+        label = "Voice "+str(self.count+1)
+        char_name = LabeledInput("Character Name\n(Empty=Voice Name)")
+        voice_picker = gen_voice_picker(label, user=self.user, voiceList=self.voice_list, includeNone=True)
+        gender_input = LabeledInput("Character Gender", data=["female","male", "other"], comboboxMinimumSize=10)
+        new_container.addWidget(char_name)
+        new_container.addWidget(voice_picker)
+        new_container.addWidget(gender_input)
+        self.container_layout.addLayout(new_container)
+        self.pickers.append((char_name, voice_picker, gender_input))
+        self.count += 1
+        char_name.line_edit.textChanged.connect(self.publish_roster)
+        voice_picker.combo_box.currentIndexChanged.connect(self.publish_roster)
+        gender_input.combo_box.currentIndexChanged.connect(self.publish_roster)
+        self.publish_roster()
+        width = 0
+        width += char_name.width()
+        width += voice_picker.width()
+        width += gender_input.width()
+
+        target_height = int(voice_picker.height()/1.5)
+        if self.height() >= target_height:
+            target_height = self.height()
+        self.resize(int(width/2), target_height)
+
+    def remove_widget(self):
+        if self.count > 0:
+            layout = self.container_layout.itemAt(self.count - 1)
+
+            # Remove all widgets in the layout
+            while layout.count():
+                child = layout.takeAt(0)
+                child.widget().deleteLater()
+
+            self.container_layout.removeItem(layout)
+            self.pickers.pop()
+            self.count -= 1
+            self.publish_roster()
+
+    def refresh_voices(self):
+        #Runs in the background.
+        try:
+            voices = self.user.get_available_voices()
+        except Exception as e:
+            print(f"Could not refresh the voice list: {e}")
+            return
+        helper.save_voice_list(self.voice_list_file, voices)
+        if self.startup_profile is not None:
+            self.startup_profile.mark_background("Voice list refresh")
+        self.voices_refreshed.emit(voices)
+
+    def set_voice_list(self, voices):
+        self.voice_list = voices
+        data = [helper.ComboBoxItem(None, "None")] + helper.get_list_of_voice_texts(self.user, voices)
+        previous_voices = self.get_voices()
+        for _, voice_picker, _ in self.pickers:
+            voice_picker.set_items(data)
+        #Only the labels should change. Saving anyway would rewrite the roster file for every other instance using it.
+        if self.get_voices() != previous_voices:
+            self.publish_roster()
+
+    def publish_roster(self, *args):
+        #Runs on the GUI thread whenever a picker changes. The request handlers only ever read the published snapshot.
+        if not self._loading:
+            self.roster_file.save(self.get_voices())
+
+    def set_roster(self, voice_dict:dict):
+        #Replaces the pickers with the given characters.
+        self._loading = True
+        try:
+            while self.count > 0:
+                self.remove_widget()
+            for name, data in voice_dict.items():
+                self.add_voice_picker()
+                char_name, voice_picker, gender_input = self.pickers[-1]
+                char_name.set_value(name)
+                voice_picker.set_value(data.get("id"), label=data.get("id"))
+                gender_input.set_value(data.get("gender"))
+        finally:
+            self._loading = False
+
+    def on_roster_changed(self, voice_dict:dict):
+        if voice_dict != self.get_voices():
+            self.set_roster(voice_dict)
+
+    def show_lines(self, text:str):
+        #Can be called from any thread.
+        QMetaObject.invokeMethod(self.last_lines, "setText", Qt.ConnectionType.AutoConnection, Q_ARG(str, text))
+
+    def get_voices(self):
+        voice_dict = dict()
+        for name_input, voice_input, gender_input in self.pickers:
+            char_name = name_input.get_text()
+            if char_name == "":
+                char_name = voice_input.get_text()
+            voice_dict[char_name] = {"gender":gender_input.get_text(),"id":voice_input.get_value()}
+
+        return voice_dict
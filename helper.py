@@ -1,9 +1,11 @@
 from __future__ import annotations
+import json
 import os
 
-from typing import Union, Optional, List
-from elevenlabslib import User
-from elevenlabslib.Voice import Voice
+from typing import Union, Optional, List, TYPE_CHECKING
+if TYPE_CHECKING:
+    from elevenlabslib import User
+    from elevenlabslib.Voice import Voice
 
 
 class ComboBoxItem(object):
@@ -33,6 +35,29 @@ def get_stylesheet():
         styleSheet = styleSheet.replace("{" + colorKey + "}", colorValue)
     return styleSheet
 
+class CachedVoice:
+    #Stands in for a Voice in the voice pickers (only has what they show), until the real list is fetched.
+    def __init__(self, voiceID, name, category):
+        self.voiceID = voiceID
+        self.name = name
+        self.category = category
+
+def load_voice_list(path) -> List[CachedVoice]:
+    if not os.path.isfile(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf8") as fp:
+            return [CachedVoice(voice["voice_id"], voice["name"], voice.get("category")) for voice in json.load(fp)]
+    except (OSError, ValueError, KeyError):
+        print(f"Could not read the saved voice list at {path}.")
+        return []
+
+def save_voice_list(path, voiceList:List[Voice]):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf8") as fp:
+        json.dump([{"voice_id": voice.voiceID, "name": voice.name, "category": voice.category} for voice in voiceList], fp)
+    os.replace(temp_path, path)
+
 def get_list_of_voice_texts(user: User | None, voiceList:List[Voice]=None):
     if voiceList is None:
         voiceList = user.get_available_voices()
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+import traceback
+from typing import Callable, Optional
+
+class HistoryJanitor:
+    """
+    Deletes the history items created by our own generations, on a background thread so it never delays playback.
+    Only the IDs passed to add() are ever deleted.
+    Arguments:
+        delete_func: Deletes the history item with the given ID. Raising means the deletion failed and will be retried.
+        retention: Seconds to keep an item before deleting it. 0 deletes items right away, None never deletes them.
+        batch_size: How many items are deleted each time the janitor wakes up.
+        interval: Seconds between batches.
+        max_attempts: How many times to try deleting an item before giving up on it.
+        state_file: If set, pending items are saved here so they survive restarts.
+    """
+    def __init__(self, delete_func:Callable[[str], None], retention:Optional[float]=0, batch_size:int=10, interval:float=2,
+                 max_attempts:int=5, state_file:str=None):
+        self.delete_func = delete_func
+        self.retention = retention
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = dict()  #history item ID -> {"due": timestamp, "attempts": int}
+        self._stats = {"added": 0, "deleted": 0, "failed_attempts": 0, "given_up": 0}
+        if state_file is not None and os.path.isfile(state_file):
+            try:
+                with open(state_file, "r", encoding="utf8") as fp:
+                    self._pending = json.load(fp)
+            except (OSError, ValueError):
+                print(f"Could not read {state_file}, pending history deletions were lost.")
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="history-janitor")
+        self._thread.start()
+
+    def add(self, history_item_id:Optional[str]):
+        if history_item_id is None or self.retention is None:
+            return
+        with self._lock:
+            self._pending[history_item_id] = {"due": time.time() + self.retention, "attempts": 0}
+            self._stats["added"] += 1
+            self._save()
+        if self.retention == 0:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+            return stats
+
+    def _save(self):
+        #Must be called with the lock held.
+        if self.state_file is None:
+            return
+        temp_path = f"{self.state_file}.tmp"
+        with open(temp_path, "w", encoding="utf8") as fp:
+            json.dump(self._pending, fp)
+        os.replace(temp_path, self.state_file)
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            now = time.time()
+            with self._lock:
+                due = sorted((item for item in self._pending.items() if item[1]["due"] <= now), key=lambda item: item[1]["due"])
+                batch = [history_item_id for history_item_id, _ in due[:self.batch_size]]
+
+            for history_item_id in batch:
+                try:
+                    self.delete_func(history_item_id)
+                    with self._lock:
+                        self._pending.pop(history_item_id, None)
+                        self._stats["deleted"] += 1
+                except Exception:
+                    traceback.print_exc()
+                    with self._lock:
+                        entry = self._pending.get(history_item_id)
+                        self._stats["failed_attempts"] += 1
+                        if entry is not None:
+                            entry["attempts"] += 1
+                            if entry["attempts"] >= self.max_attempts:
+                                print(f"Giving up on deleting history item {history_item_id}.")
+                                del self._pending[history_item_id]
+                                self._stats["given_up"] += 1
+                            else:
+                                #Back off exponentially before the next attempt.
+                                entry["due"] = time.time() + self.interval * 2 ** entry["attempts"]
+
+            if len(batch) > 0:
+                with self._lock:
+                    self._save()
+                    if len(batch) == self.batch_size:
+                        self._wakeup.set()
@@ -0,0 +1,227 @@
+import itertools
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+#Possible job states, in the order a job normally goes through them.
+QUEUED = "queued"
+EXTRACTING = "extracting"
+SYNTHESIZING = "synthesizing"
+PLAYING = "playing"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+class Job:
+    """
+    A single speech request. Keeps track of its current state and how long it spent in each one.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, text:str, roster:Any, options:dict=None, key:str=None):
+        self.id = str(next(Job._ids))
+        self.text = text
+        self.roster = roster
+        self.options = options if options is not None else dict()
+        self.key = key              #Requests with the same key are merged into this job while it's running
+        self.duplicates = 0
+        self.state = QUEUED
+        self.error:Optional[str] = None
+        self.message:Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at:Optional[float] = None
+        self.timings = dict()
+        self.events = dict()
+        self.extraction = dict()    #How the dialog was extracted (local/cache/LLM) and what it cost
+        self.spans = list()         #Timed stages, see metrics.Tracer
+        self._lock = threading.Lock()
+        self._created_perf = time.perf_counter()
+        self._state_started = self._created_perf
+        self._done_event = threading.Event()
+        self.cancel_event = threading.Event()
+        self._cancel_callbacks = list()
+
+    def set_state(self, state:str, message:str=None):
+        with self._lock:
+            now = time.perf_counter()
+            self.timings[self.state] = self.timings.get(self.state, 0) + (now - self._state_started)
+            self._state_started = now
+            self.state = state
+            if message is not None:
+                self.message = message
+            if state in FINISHED_STATES:
+                self.finished_at = time.time()
+                self._done_event.set()
+
+    def mark(self, event:str):
+        #Records when something happened, in seconds since the job was created. Only the first occurrence is kept.
+        with self._lock:
+            if event not in self.events:
+                self.events[event] = time.perf_counter() - self._created_perf
+
+    def add_span(self, span:dict):
+        with self._lock:
+            self.spans.append(span)
+
+    def fail(self, error:str):
+        self.error = error
+        self.set_state(FAILED)
+
+    def cancel(self) -> bool:
+        #Asks the job to stop. Whatever is processing it is told through the cancel callbacks. Returns False if it was already finished.
+        with self._lock:
+            if self.state in FINISHED_STATES or self.cancel_event.is_set():
+                return False
+            self.cancel_event.set()
+            callbacks = list(self._cancel_callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        return True
+
+    def add_cancel_callback(self, callback:Callable[[], None]):
+        #Called right away if the job was already cancelled.
+        with self._lock:
+            if not self.cancel_event.is_set():
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def wait(self, timeout:float=None) -> bool:
+        return self._done_event.wait(timeout)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            timings = {state: round(seconds, 3) for state, seconds in self.timings.items()}
+            if self.state not in FINISHED_STATES:
+                timings[self.state] = round(timings.get(self.state, 0) + time.perf_counter() - self._state_started, 3)
+            return {
+                "id": self.id,
+                "state": self.state,
+                "message": self.message,
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "timings": timings,
+                "events": {event: round(seconds, 3) for event, seconds in self.events.items()},
+                "duplicates": self.duplicates,
+                "extraction": dict(self.extraction),
+                "spans": list(self.spans),
+                "time_to_first_audio": round(self.events["first_audio"], 3) if "first_audio" in self.events else None
+            }
+
+class JobQueue:
+    """
+    Runs jobs on a pool of worker threads.
+    Arguments:
+        handler: The function each job is passed to. It's responsible for moving the job through its states, and should end with it in DONE.
+        workers: The number of jobs that can be processed at the same time.
+        max_finished: How many finished jobs to keep around for status queries.
+        on_finished: Called with every job once it's done or failed.
+    """
+    def __init__(self, handler:Callable[[Job], None], workers:int=2, max_finished:int=100, on_finished:Callable[[Job], None]=None):
+        self.handler = handler
+        self.on_finished = on_finished
+        self.max_finished = max_finished
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._active = 0    #Queued or running
+        self._idle = threading.Condition(self._lock)
+        self.accepting = True
+        self._workers = [threading.Thread(target=self._worker_loop, daemon=True, name=f"job-worker-{i}") for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, text:str, roster:Any, options:dict=None, key:str=None) -> Job:
+        return self.submit_unique(text, roster, options, key)[0]
+
+    def submit_unique(self, text:str, roster:Any, options:dict=None, key:str=None) -> tuple[Job, bool]:
+        #If a job with the same key is still queued or running, it's returned instead of a new one. The bool is whether the job is new.
+        with self._lock:
+            if not self.accepting:
+                raise RuntimeError("The job queue is shutting down.")
+            if key is not None:
+                for existing in self._jobs.values():
+                    if existing.key == key and not existing.finished and not existing.cancelled:
+                        existing.duplicates += 1
+                        return existing, False
+            job = Job(text, roster, options, key)
+            self._jobs[job.id] = job
+            self._active += 1
+            self._prune()
+        self._queue.put(job)
+        return job, True
+
+    def get(self, job_id:str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def unfinished(self) -> list[Job]:
+        #Queued and running jobs, oldest first.
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def active(self) -> int:
+        with self._lock:
+            return self._active
+
+    def drain(self, timeout:float=None) -> bool:
+        #Stops accepting new jobs, then waits for the queued and running ones to finish. Returns False on timeout.
+        with self._idle:
+            self.accepting = False
+            return self._idle.wait_for(lambda: self._active == 0, timeout)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if not job.cancelled:
+                    self.handler(job)
+                if job.cancelled and not job.finished:
+                    job.set_state(CANCELLED, "Cancelled.")
+                elif not job.finished:
+                    job.set_state(DONE)
+            except Exception as e:
+                if job.cancelled:
+                    job.set_state(CANCELLED, "Cancelled.")
+                else:
+                    traceback.print_exc()
+                    job.fail(f"{type(e).__name__}: {e}")
+            finally:
+                if self.on_finished is not None:
+                    try:
+                        self.on_finished(job)
+                    except Exception:
+                        traceback.print_exc()
+                self._queue.task_done()
+                with self._idle:
+                    self._active -= 1
+                    self._idle.notify_all()
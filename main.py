@@ -1,362 +1,710 @@
-import json
+import hashlib
 import os
 import signal
 import sys
 import threading
 import time
-import typing
-
-import requests
-from PyQt6 import QtGui
-from PyQt6.QtCore import QEvent, QMetaObject, Qt, Q_ARG
-from PyQt6.QtGui import QIcon, QFont
-from elevenlabslib.Voice import Voice
-from elevenlabslib.utils import play_dialog_with_stitching
-from flask import Flask, request, jsonify
+from typing import Callable
+
+from startup_profile import StartupProfile
+startup_profile = StartupProfile("--profile-startup" in sys.argv)
+from flask import Flask, Response, request, jsonify
 import keyring
-from PyQt6.QtWidgets import (QApplication, QVBoxLayout, QWidget, QPushButton, QScrollArea, QFrame, QSizePolicy, QHBoxLayout, QLayout, QSystemTrayIcon, QMenu, QDialog, QMainWindow, QLabel)
-from elevenlabslib import *
+import keyring.errors
+startup_profile.mark("import flask, keyring")
 
+#openai and elevenlabslib are only imported once they're needed, they're the slowest to load.
 import helper
-import openai
-from customWidgets import LabeledInput, gen_voice_picker
+from api_clients import ProviderClient
+from audio_cache import AudioCache
+from backends import AudioSink, DialogExtractor, SpeechSynthesizer, OpenAIExtractor, ElevenLabsSynthesizer, SpeakerSink, NullSink
+from chunked_extraction import ChunkedExtractor
+from client_stream import ClientStream
+from extraction_cache import ExtractionCache
+from history_janitor import HistoryJanitor
+from metrics import Registry, Tracer
+from roster import Roster, RosterHolder
+from roster_file import RosterFile
+from server import SpeakerServer
+from text_changes import TextChanges
+import jobs
+from quote_extractor import QuoteFastPath, parse_quotes
+from prompt_compaction import CompactText, compact_text, estimate_tokens
+from prefetch import CharacterBudget, Prefetcher
+from pipeline import Player, SpeechLine, SpeechPipeline, SynthesisScheduler
+startup_profile.mark("import GPT_Speaker modules")
 
 #Can be customized, but must be changed in the userscript as well
 flask_port = 57319
 
+#Only reachable from this machine by default. Set to "0.0.0.0" to serve other machines too (for client playback).
+server_host = "127.0.0.1"
+
+#The HTTP server runs on a pool of threads, so several tabs can send requests at once.
+server_threads = 8
+max_request_mb = 2
+#On shutdown, how many seconds to wait for the jobs that are still running.
+shutdown_timeout = 30
+
+#API calls are limited per provider. The limit is halved whenever the provider throttles us (429/Retry-After) and slowly
+#grows back, failed calls are retried with backoff, and connections are pooled.
+openai_max_concurrent = 8
+elevenlabs_max_concurrent = 4
+api_max_attempts = 4
+
+#Requests with "playback": "client" get the audio streamed back (one JSON line per line of dialog) instead of it being
+#played on this machine. While nothing is being sent, the stream is pinged every this many seconds to keep it open.
+client_stream_keepalive = 10
+#Every client stream keeps one of the server_threads busy until its job is done. At most server_threads minus this many
+#streams are served at once (the rest get a 503), so /cancel, /jobs and the other endpoints always have a thread left.
+server_threads_reserved = 2
+
+#What to do with a request that comes in while another one is still being spoken here (or waiting to be):
+#"queue" speaks it afterwards, "preempt" stops the current one(s) and speaks the new one right away, "drop" ignores it.
+#Requests can also set "policy" themselves. Clicking the same message again while it's being spoken never speaks it twice,
+#the click just gets the job that's already running. /cancel (or "Stop speaking") stops everything.
+busy_policy = "queue"
+BUSY_POLICIES = ("queue", "preempt", "drop")
+
+#With prefetch_messages on in the userscript, every message is sent here as soon as it's done, and its dialog is extracted
+#and the first few lines are generated before the button is even clicked. This only runs while nothing else is being
+#processed, and is limited to this many generated characters per hour, so messages that are never played can't use up the quota.
+#Messages that can't be extracted locally (or from the cache) also need the LLM, which is limited to this many extractions per hour.
+prefetch_enabled = True
+prefetch_warm_lines = 2
+prefetch_chars_per_hour = 5000
+prefetch_extractions_per_hour = 30
+prefetch_max_pending = 5
+
+#How many requests can be extracted/generated at the same time. Playback is always one at a time.
+job_workers = 2
+
+#How many lines can be generated ahead of the one currently playing.
+prefetch_lines = 3
+
+#How many generations can run at the same time (across all requests), and how many of them can use the same voice.
+#Keeping the per-voice limit at 1 means each voice's lines are generated in order, so request stitching works properly.
+max_concurrent_generations = 3
+max_generations_per_voice = 1
+
+#Seconds of silence between lines, depending on whether the speaking character changed.
+line_gap = 0.5
+speaker_change_gap = 0.5
+
+#Generated audio is cached here, so lines that were already spoken (re-plays, catchphrases) don't use any quota.
+audio_cache_dir = "audio_cache"
+audio_cache_max_mb = 500
+audio_cache_memory_mb = 32
+
+#The model used to extract the dialog. Bump the prompt version whenever the prompt/tools change, so old cached extractions aren't reused.
+extraction_model = "gpt-4o-mini"
+extraction_prompt_version = 1
+
+#Messages where every quote is clearly attributed ("...", said Alice) are parsed locally instead of going to the LLM,
+#and messages without quotes are skipped right away. Set the threshold to None to always use the LLM.
+#A fraction of the locally parsed messages is also sent to the LLM in the background, and how often the two agree
+#is shown in /cache, to help tune the threshold. Set the log to a file name (e.g. "quote_fast_path.jsonl") to also record
+#both versions of every compared message there. It's never trimmed, so only turn it on while tuning.
+quote_fast_path_threshold = 0.9
+quote_fast_path_compare_rate = 0.05
+quote_fast_path_log = None
+
+#Only the quotes and this many characters around them (for the attributions) are sent to the LLM, the rest of the
+#narration is dropped. Extracted lines are checked against the original text: small differences are fixed, and lines
+#that aren't in the message are dropped. Set to None to always send the whole message.
+prompt_compaction_window = 150
+
+#Every job's stages are timed (see /jobs/<id> and /metrics). Set this to a file name to also log them as JSON lines.
+trace_log_file = None
+
+#Long messages are split into chunks (at paragraph/scene breaks) that are extracted in parallel, so the extraction time
+#depends on the chunk size rather than the message length. Each chunk also gets the end of the previous one as context.
+extraction_chunk_chars = 6000
+extraction_chunk_overlap_chars = 400
+extraction_max_parallel_chunks = 4
+
+#Extracted dialog is cached per message text and character list.
+extraction_cache_file = "extraction_cache.json"
+extraction_cache_ttl_hours = 24*7
+extraction_cache_max_entries = 2000
+
+#The history items of our generations are deleted in the background, after this many hours (0 = right away, None = never delete them).
+history_retention_hours = 0
+history_janitor_file = "history_janitor.json"
+
 #This file will be used to replace the keys with the value.
 #Example: {"Jack":"Jill"} means that any mention of "Jack" will be replaced with "Jill" when it's being spoken.
-#Useful to fix pronounciation errors for acronyms and the like.
+#Useful to fix pronounciation errors for acronyms and the like. Changes to the file are picked up automatically.
+#Longer keys take priority over shorter ones, and replaced text is never replaced again.
 text_changes_file = "text_changes.json"
-logo_path = os.path.join("resources","logo.png")
-if os.path.isfile(text_changes_file):
-    text_changes = json.load(open(text_changes_file, "r"))
-else:
-    text_changes = {}
-    json.dump(text_changes, open(text_changes_file,"w"))
-
-#This function is run whenever a playback ends. I use it to add a small delay to make it sound more natural.
-def playback_end_func():
-    time.sleep(0.5)
-    elevenlabs_user.get_history_items_paginated(1)[0].delete()
+text_changes_whole_words = False    #Only replace keys that aren't part of a longer word
+text_changes_ignore_case = False
+
+#The characters and their voices. The GUI saves them here, and headless instances (--headless) load them from here,
+#reloading the file whenever it changes. Can be JSON or TOML (see roster_file.py), and --roster <file> overrides it.
+roster_file_path = "roster.json"
+
+#The last list of voices is saved here, so the voice pickers can be filled right away while it's refreshed in the background.
+voice_list_file = "voice_list.json"
+text_changes = TextChanges(text_changes_file, whole_words=text_changes_whole_words, ignore_case=text_changes_ignore_case)
 
 #For other info, the instructions GPT-3.5 gets mean that it will _only_ synthesize the text present in quotes (more or less).
 #If your text is in a different format, you'll have to adjust them accordingly.
 #Also, the "Gender" input is to help it tell characters apart when only pronouns are being used.
 
-class AskKeys(QDialog):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("API Keys Input")
-        self.main_layout = QVBoxLayout()
-        self.elevenlabs_api_key = LabeledInput(label="Elevenlabs API Key", configKey="elevenlabs_api_key", protected=True)
-        self.openai_api_key = LabeledInput(label="OpenAI API Key", configKey="openai_api_key", protected=True)
-        self.elevenlabs_model = LabeledInput(label="TTS Model", configKey="elevenlabs_model", protected=False, data="eleven_multilingual_v2")
-        self.main_layout.addWidget(self.elevenlabs_api_key)
-        self.main_layout.addWidget(self.openai_api_key)
-        self.main_layout.addWidget(self.elevenlabs_model)
-
-        self.done_button = QPushButton("Done")
-        self.done_button.clicked.connect(lambda: self.done(0))
-        self.main_layout.addWidget(self.done_button)
-        self.setLayout(self.main_layout)
-    def closeEvent(self, a0: typing.Optional[QtGui.QCloseEvent]) -> None:
-        self.done(-1)
-
-class VoicePickerUI(QMainWindow):
-    #Yes, I generated a lot of the UI code with GPT-4 because I'm lazy.
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("GPT Speaker")
-        self.initUI()
-
-    def initUI(self):
-        self.user = elevenlabs_user
-        self.voice_list = self.user.get_available_voices()
-        self.main_widget = QWidget(self)
-        self.main_layout = QVBoxLayout(self.main_widget)
-        self.main_layout.setSizeConstraint(QLayout.SizeConstraint.SetNoConstraint)
-
-        self.scroll_area = QScrollArea(self.main_widget)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
-
-        self.container = QWidget(self.scroll_area)
-        self.scroll_area.setWidget(self.container)
-        self.container_layout = QVBoxLayout(self.container)
-        button_container = QHBoxLayout()
-        self.button_add = QPushButton('Add')
-        self.button_remove = QPushButton('Remove')
-        button_container.addWidget(self.button_add)
-        button_container.addWidget(self.button_remove)
-        self.button_add.clicked.connect(self.add_voice_picker)
-        self.button_remove.clicked.connect(self.remove_widget)
-
-        self.main_layout.addWidget(self.scroll_area)
-        self.main_layout.addLayout(button_container)
-        self.last_lines = QLabel("")
-        self.last_lines.setFont(QFont('Arial', 12))
-        self.last_lines.setWordWrap(True)
-        self.main_layout.addWidget(self.last_lines)
-
-        self.count = 0
-        wrapper_widget = QWidget()
-        wrapper_widget.setLayout(self.main_layout)
-        self.setCentralWidget(wrapper_widget)
-
-
-        #System icon setup
-        self.trayIcon = QSystemTrayIcon(self)
-        self.trayIcon.setIcon(QIcon(logo_path))
-
-        # Create a menu for the tray icon
-        trayMenu = QMenu()
-        restoreAction = trayMenu.addAction("Restore")
-        restoreAction.triggered.connect(self.showNormal)
-        exitAction = trayMenu.addAction("Exit")
-        exitAction.triggered.connect(self.close)
-
-        self.trayIcon.setContextMenu(trayMenu)
-        self.trayIcon.activated.connect(self.onTrayIconActivated)
-
-
-    def closeEvent(self, event):
-        self.trayIcon.hide()
-        gui_app.exit(0)
-
-    def changeEvent(self, event):
-        if event.type() == QEvent.Type.WindowStateChange:
-            if self.isMinimized():
-                self.hide()
-                self.trayIcon.show()
-                event.ignore()
-
-    def onTrayIconActivated(self, reason):
-        if reason == QSystemTrayIcon.ActivationReason.DoubleClick:
-            self.showNormal()
-
-
-    def add_voice_picker(self):
-        new_container = QHBoxLayout()
-
-        label = "Voice "+str(self.count+1)
-        char_name = LabeledInput("Character Name\n(Empty=Voice Name)")
-        voice_picker = gen_voice_picker(label, user=self.user, voiceList=self.voice_list, includeNone=True)
-        gender_input = LabeledInput("Character Gender", data=["female","male", "other"], comboboxMinimumSize=10)
-        new_container.addWidget(char_name)
-        new_container.addWidget(voice_picker)
-        new_container.addWidget(gender_input)
-        self.container_layout.addLayout(new_container)
-        self.count += 1
-        width = 0
-        width += char_name.width()
-        width += voice_picker.width()
-        width += gender_input.width()
-
-        target_height = int(voice_picker.height()/1.5)
-        if self.height() >= target_height:
-            target_height = self.height()
-        self.resize(int(width/2), target_height)
-
-    def remove_widget(self):
-        if self.count > 0:
-            layout = self.container_layout.itemAt(self.count - 1)
-
-            # Remove all widgets in the layout
-            while layout.count():
-                child = layout.takeAt(0)
-                child.widget().deleteLater()
-
-            self.container_layout.removeItem(layout)
-            self.count -= 1
-
-    def get_voices(self):
-        voice_dict = dict()
-        for i in range(self.container_layout.count()):
-            layout = self.container_layout.itemAt(i)
-
-            # Since the widgets are containers, treat the widgets specially
-            if layout.widget() is None:
-                voice_input = None
-                gender_input = None
-                name_input = None
-                # Iterate over the widgets within the sub-layout
-                for j in range(layout.count()):
-                    widget = layout.itemAt(j).widget()
-
-                    if widget.line_edit is not None:
-                        name_input = widget
-                    else:
-                        if widget.combo_box.count() == 3 and widget.combo_box.itemData(0) in ["male","female","other"]:
-                            gender_input = widget
-                        else:
-                            voice_input = widget
-
-                # Now you can operate on the pairs of widgets
-                if voice_input is not None and gender_input is not None:
-                    char_name = name_input.get_text()
-                    if char_name == "":
-                        char_name = voice_input.get_text()
-                    voice_dict[char_name] = {"gender":gender_input.get_text(),"id":voice_input.get_value()}
-
-        return voice_dict
-
 from flask_cors import CORS
 flask_app = Flask(__name__)
+flask_app.config["MAX_CONTENT_LENGTH"] = max_request_mb*1024*1024
 CORS(flask_app)
-voice_cache = dict()
-
-playback_options = PlaybackOptions(onPlaybackEnd=playback_end_func)
+roster_holder = RosterHolder()
+roster_file = None
+show_lines = None   #Set by the GUI to show the lines as they're spoken
+job_queue = None
+http_server = None
+speech_synthesizer = None
+history_janitor = None
+prefetcher = None
+prefetch_extraction_budget = None
+extraction_cache = ExtractionCache(extraction_cache_file, ttl=extraction_cache_ttl_hours*3600, max_entries=extraction_cache_max_entries)
+audio_cache = AudioCache(audio_cache_dir, max_bytes=audio_cache_max_mb*1024*1024, memory_max_bytes=audio_cache_memory_mb*1024*1024)
+metrics_registry = Registry()
+tracer = Tracer(metrics_registry, log_file=trace_log_file)
+jobs_total = metrics_registry.counter("gpt_speaker_jobs_total", "Finished jobs.", labels=("state",))
+job_seconds = metrics_registry.histogram("gpt_speaker_job_seconds", "Time from a job being queued to it being finished.")
+time_to_first_audio_seconds = metrics_registry.histogram("gpt_speaker_time_to_first_audio_seconds", "Time from a job being queued to its first line playing.")
+extractions_total = metrics_registry.counter("gpt_speaker_extractions_total", "Dialog extractions, by how they were done.", labels=("method",))
+cache_requests_total = metrics_registry.counter("gpt_speaker_cache_requests_total", "Cache lookups.", labels=("cache", "result"))
+characters_synthesized_total = metrics_registry.counter("gpt_speaker_characters_synthesized_total", "Characters sent to the TTS API.")
+lines_total = metrics_registry.counter("gpt_speaker_lines_total", "Lines of dialog, by where their audio came from.", labels=("source",))
+client_stream_lock = threading.Lock()
+client_streams_rejected_total = metrics_registry.counter("gpt_speaker_client_streams_rejected_total", "Client playback requests turned away because every stream slot was taken.")
+busy_requests_total = metrics_registry.counter("gpt_speaker_busy_requests_total", "Requests that came in while another one was being spoken, by what was done with them.", labels=("outcome",))
+prefetch_requests_total = metrics_registry.counter("gpt_speaker_prefetch_requests_total", "Prefetch requests, by what was done with them.", labels=("status",))
+api_errors_total = metrics_registry.counter("gpt_speaker_api_errors_total", "Failed API calls.", labels=("operation",))
+api_providers = dict()
+def provider_stat(stat:str):
+    return lambda: {(name,): provider.stats()[stat] for name, provider in api_providers.items()}
+metrics_registry.gauge("gpt_speaker_api_in_flight", "API requests in flight.", labels=("provider",), func=provider_stat("in_flight"))
+metrics_registry.gauge("gpt_speaker_api_concurrency_limit", "Current adaptive concurrency limit.", labels=("provider",), func=provider_stat("concurrency_limit"))
+metrics_registry.counter("gpt_speaker_api_requests_total", "API requests, including retries.", labels=("provider",), func=provider_stat("requests"))
+metrics_registry.counter("gpt_speaker_api_throttled_total", "API requests that were throttled (429/503).", labels=("provider",), func=provider_stat("throttled"))
+metrics_registry.counter("gpt_speaker_api_retries_total", "API requests that were retried.", labels=("provider",), func=provider_stat("retries"))
+metrics_registry.gauge("gpt_speaker_queue_depth", "Jobs waiting for a worker.", func=lambda: job_queue.depth() if job_queue is not None else 0)
+metrics_registry.gauge("gpt_speaker_active_jobs", "Jobs queued or running.", func=lambda: job_queue.active() if job_queue is not None else 0)
+metrics_registry.gauge("gpt_speaker_prefetch_budget_remaining", "Characters left in the prefetch budget for the current hour.",
+                       func=lambda: min(prefetcher.budget.remaining(), 1e12) if prefetcher is not None else 0)
+metrics_registry.gauge("gpt_speaker_prefetch_extraction_budget_remaining", "LLM extractions left in the prefetch budget for the current hour.",
+                       func=lambda: min(prefetch_extraction_budget.remaining(), 1e12) if prefetch_extraction_budget is not None else 0)
+metrics_registry.gauge("gpt_speaker_history_pending", "History items waiting to be deleted.", func=lambda: history_janitor.stats()["pending"] if history_janitor is not None else 0)
+quote_fast_path = QuoteFastPath(quote_fast_path_threshold, compare_rate=quote_fast_path_compare_rate, log_file=quote_fast_path_log)
 
 @flask_app.route('/', methods=['GET'])
 def home():
     # Just a simple test to make sure it's working
     return jsonify({"message": "GPT_Speaker (v3) test page"}), 200
 
+@flask_app.route('/health', methods=['GET'])
+def health():
+    # Ready means the server can take new requests right now (services running, not shutting down, and at least one voice).
+    started = job_queue is not None
+    accepting = started and job_queue.accepting
+    ready = accepting and len(roster_holder.current) > 0
+    status = {
+        "status": "ok" if accepting else ("draining" if started else "starting"),
+        "ready": ready,
+        "voices": len(roster_holder.current),
+        "queue_depth": job_queue.depth() if started else 0,
+        "active_jobs": job_queue.active() if started else 0
+    }
+    return jsonify(status), 200 if ready else 503
+
 @flask_app.route('/stopServer', methods=['GET'])
 def stopServer():
-    os.kill(os.getpid(), signal.SIGINT)
+    # Stopping waits for the running jobs, so it can't happen on the request thread.
+    threading.Thread(target=stop_server).start()
     return jsonify({ "success": True, "message": "Server is shutting down..." })
 
 @flask_app.route('/generate_extract_audio', methods=['POST'])
 def generate_audio():
     # Get the body of text from the request
-    if not request.is_json:
-        return jsonify({"error": "Invalid request format."}), 400
-    text = request.get_json().get("text")
-
-    # Call the openAI API to get the JSON
-    voice_dict = ex.get_voices()
-    print(voice_dict)
+    parse_start_time, parse_start = time.time(), time.perf_counter()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("text"), str) or data["text"].strip() == "":
+        return jsonify({"error": "Invalid request format, expected {\"text\": \"...\"}."}), 400
+    text = data["text"]
+    # Set "bypass_extraction_cache" to force a new extraction (the result still replaces the cached one).
+    options = {"bypass_extraction_cache": bool(data.get("bypass_extraction_cache", False))}
+    # Set "playback" to "client" to get the audio back instead of playing it here.
+    client_playback = data.get("playback", "local") == "client"
+
+    parse_time = time.perf_counter() - parse_start
+    # The UI publishes a new roster whenever the voices change, so there's no need to touch the widgets here.
+    roster_start_time, roster_start = time.time(), time.perf_counter()
+    roster = roster_holder.current
+    roster_time = time.perf_counter() - roster_start
+    print(roster.to_dict())
     print(text)
-    if len(voice_dict) == 0:
+    if len(roster) == 0:
         return jsonify({"message": "Audio generation not run, no voices."}), 200
 
-    messages = list()
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "speak",
-                    "description": "Speaks the given prompt as a chosen character.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "speech_data": {
-                                "type": "array",
-                                "items" : {
-                                    "type": "object",
-                                    "properties": {
-                                        "character": {
-                                            "type": 'string',
-                                            "enum": list(voice_dict.keys()),
-                                            "description": 'The name of the character speaking the line.'
-                                        },
-                                        "text": {
-                                            "type": 'string',
-                                            "description": 'The line the character should speak.'
-                                        }
-                                    }
-                                }
-                            }
-                        },
-                        "required": ["speech_data"]
-                    }
-            }
-        }
-    ]
-
-    messages.append({"role": "system",
-                     "content": "Your job is to act as a dialog speaker. You will extract the quoted"
-                     "(in quotes) dialog from the provided input and speak it using the provided function."
-                     "\nYou must NOT modify the text, only extract the dialog."
-                     "\nIf a character does not has an associated voice, ignore it."})
-    messages.append({"role": "user", "content": text})
-    messages.append({"role": "user", "content": "Please speak the dialog from the previous message."})
-    messages[-1]["content"] += f"\nThe characters you can choose from are:\n"
-
-    for character_name, data in voice_dict.items():
-        messages[-1]["content"] += f"- '{character_name}' (Gender: {data.get('gender')})\n"
-
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        tools=tools,
-        tool_choice={"type": "function", "function": {"name": "speak"}}
-    )
-
-    response_dict = response.choices[0].message.model_dump()
-
-    tool_call = response_dict.get("tool_calls")
-    if tool_call is None:
-        print("Got back no calls. Exiting.")
-        return
+    # The actual work is done by the job queue, so we can return immediately.
+    if not job_queue.accepting:
+        return jsonify({"error": "Server is shutting down."}), 503
+    if client_playback:
+        # Every listener gets its own stream, so these are never merged or preempted. The check and the submit are
+        # done under the lock so concurrent requests can't go over the limit together.
+        with client_stream_lock:
+            limit = max(server_threads - server_threads_reserved, 1)
+            if len(client_stream_jobs()) >= limit:
+                client_streams_rejected_total.inc()
+                return jsonify({"error": f"Already streaming to {limit} clients, try again later."}), 503, {"Retry-After": "5"}
+            options["client_stream"] = ClientStream(line_gap=line_gap, speaker_change_gap=speaker_change_gap, keepalive=client_stream_keepalive)
+            job = job_queue.submit(text, roster, options)
+        tracer.record("request_parsing", parse_time, parse_start_time, job)
+        tracer.record("roster_snapshot", roster_time, roster_start_time, job, {"roster_version": roster.version})
+        return Response(options["client_stream"].events(job), 200, mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+    policy = data.get("policy", busy_policy)
+    if policy not in BUSY_POLICIES:
+        return jsonify({"error": f"Unknown policy '{policy}', must be one of {', '.join(BUSY_POLICIES)}."}), 400
+    job_key = request_key(text, roster)
+    busy = [job for job in local_jobs() if job.key != job_key]
+    if len(busy) > 0 and policy == "drop":
+        busy_requests_total.inc(outcome="dropped")
+        return jsonify({"message": "Another message is still being spoken, dropped this one.", "busy_job_ids": [job.id for job in busy]}), 409
+    if len(busy) > 0 and policy == "preempt":
+        busy_requests_total.inc(outcome="preempted")
+        for job in busy:
+            job.cancel()
+    job, new = job_queue.submit_unique(text, roster, options, key=job_key)
+    if not new:
+        busy_requests_total.inc(outcome="coalesced")
+        return jsonify({"message": "Already being spoken.", "job_id": job.id, "status_url": f"/jobs/{job.id}", "coalesced": True}), 200
+    tracer.record("request_parsing", parse_time, parse_start_time, job)
+    tracer.record("roster_snapshot", roster_time, roster_start_time, job, {"roster_version": roster.version})
+    return jsonify({"message": "Audio generation queued.", "job_id": job.id, "status_url": f"/jobs/{job.id}"}), 202
+
+@flask_app.route('/cancel', methods=['POST'])
+def cancel():
+    # Cancels the job with the given job_id, or everything that's being spoken here if there's none.
+    data = request.get_json(silent=True) or dict()
+    job_id = data.get("job_id", request.args.get("job_id"))
+    if job_id is not None:
+        job = job_queue.get(str(job_id))
+        if job is None:
+            return jsonify({"error": "Job not found."}), 404
+        cancelled = [job.id] if job.cancel() else []
     else:
-        tool_call = tool_call[0]
-
-    speech_data = json.loads(tool_call.get("function").get("arguments")).get("speech_data")
-    print(speech_data)
-    lines = speech_data
-    all_text = ""
-    # Process each character line in the request
-    lines_by_character = dict()
-    for item in lines:
-        character = item.get("character")
-        text = item.get("text")
-        if item.get("character") not in lines_by_character:
-            lines_by_character[character] = [text]
-        else:
-            lines_by_character[character].append(text)
-
-    for character, texts in lines_by_character.items():
-        for text in texts:
-            for key, value in text_changes.items():
-                text = text.replace(key, value)
-            all_text += f"{character}: {text}\n\n"
-
-    all_text = all_text.strip()
-    QMetaObject.invokeMethod(ex.last_lines, "setText", Qt.ConnectionType.AutoConnection, Q_ARG(str, all_text))
-
-    for character, texts in lines_by_character.items():
-        #We use fuzzy matching to get the most likely voice.
-        from fuzzywuzzy import process
-        matches = process.extract(character, list(voice_dict.keys()), limit=None)
-        most_likely_match = voice_dict[matches[0][0]].get("id")
-        cached_voice = voice_cache.get(character)
-        print(f"Trying to find voice corresponding to {character}")
-        print(cached_voice)
-        print(most_likely_match)
-
-        if character not in voice_cache or (cached_voice is None and most_likely_match is not None) or (cached_voice is not None and cached_voice.voiceID != most_likely_match):
-            try:
-                if most_likely_match is None:
-                    raise IndexError
-                voice_cache[character] = elevenlabs_user.get_voice_by_ID(most_likely_match)
-            except IndexError:
-                voice_cache[character] = None
-
-        voice:Voice = voice_cache[character]
-
-        if voice is not None:
-            print(f"Character: {character}, Voice: {voice.name if voice is not None else ''}, Text: {text}")
-            play_dialog_with_stitching(voice, texts, generation_options, default_playback_options=playback_options, auto_determine_emotion=True)
-        else:
-            print(f"Voice not found, skipping text '{text}'")
-
-    # Return a success response
-    return jsonify({"message": "Audio generation successful."}), 200
+        cancelled = cancel_local_jobs()
+    return jsonify({"message": f"Cancelled {len(cancelled)} jobs.", "cancelled": cancelled}), 200
 
+@flask_app.route('/prefetch', methods=['POST'])
+def prefetch():
+    # Low priority: the message is extracted and its first lines generated in the background, in case it's played later.
+    if not request.is_json or not isinstance(request.get_json().get("text"), str):
+        return jsonify({"error": "Invalid request format."}), 400
+    roster = roster_holder.current
+    if prefetcher is None or len(roster) == 0 or (job_queue is not None and not job_queue.accepting):
+        return jsonify({"status": "disabled"}), 200
+    status = prefetcher.submit(request_key(request.get_json()["text"], roster), request.get_json()["text"], roster)
+    prefetch_requests_total.inc(status=status)
+    return jsonify({"status": status}), 202 if status == "queued" else 200
+
+def request_key(text:str, roster:Roster) -> str:
+    #Identifies a message as spoken with a specific roster (duplicate requests and prefetches are matched on this).
+    return hashlib.sha256(f"{roster.fingerprint}\n{roster.version}\n{text}".encode("utf-8")).hexdigest()
+
+def client_stream_jobs() -> list[jobs.Job]:
+    #Unfinished jobs whose client is still connected, each of which holds a server thread.
+    return [job for job in job_queue.unfinished() if job.options.get("client_stream") is not None and not job.options["client_stream"].closed]
+
+def local_jobs() -> list[jobs.Job]:
+    #Unfinished jobs that play on this machine (not streamed to a client).
+    return [job for job in job_queue.unfinished() if job.options.get("client_stream") is None] if job_queue is not None else []
+
+def cancel_local_jobs(*args) -> list[str]:
+    return [job.id for job in local_jobs() if job.cancel()]
+
+@flask_app.route('/cache', methods=['GET'])
+def cache_stats():
+    return jsonify({"audio": audio_cache.stats(), "extraction": extraction_cache.stats(), "quote_fast_path": quote_fast_path.stats(),
+                    "history_janitor": history_janitor.stats(), "prefetch": dict(prefetcher.stats(), extraction_budget_remaining=prefetch_extraction_budget.remaining()) if prefetcher is not None else None}), 200
+
+@flask_app.route('/metrics', methods=['GET'])
+def metrics():
+    return metrics_registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@flask_app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({"queue_depth": job_queue.depth(), "jobs": [job.to_dict() for job in job_queue.list_jobs()]}), 200
+
+@flask_app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.to_dict()), 200
+
+def extract_dialog(text, roster:Roster, use_cache=True, info:dict=None, cancelled:threading.Event=None, allow_llm:Callable[[], bool]=None):
+    #Fills info (if given) with how the dialog was extracted. Stops early once cancelled is set.
+    #allow_llm (if given) is asked before the LLM is used, if it returns False nothing is extracted.
+    info = info if info is not None else dict()
+    # Unambiguous messages don't need the LLM at all.
+    local_extraction = parse_quotes(text, roster)
+    info["confidence"] = local_extraction.confidence
+    if quote_fast_path.accepts(local_extraction):
+        info["method"] = "local"
+        print(f"Extracted locally (confidence {local_extraction.confidence:.2f}).")
+        extractions_total.inc(method="local")
+        if quote_fast_path.should_compare(local_extraction) and (allow_llm is None or allow_llm()):
+            threading.Thread(target=compare_extraction, args=(text, roster, local_extraction), daemon=True).start()
+        yield from local_extraction.lines
+        return
 
-if __name__ == '__main__':
+    cache_key = ExtractionCache.make_key(text, roster.fingerprint, dialog_extractor.model, extraction_prompt_version)
+    if use_cache:
+        speech_data = extraction_cache.get(cache_key)
+        cache_requests_total.inc(cache="extraction", result="hit" if speech_data is not None else "miss")
+        if speech_data is not None:
+            info["method"] = "cache"
+            extractions_total.inc(method="cache")
+            print("Using cached extraction.")
+            yield from speech_data
+            return
+
+    if allow_llm is not None and not allow_llm():
+        info["method"] = "skipped"
+        return
+    info["method"] = "llm"
+    extractions_total.inc(method="llm")
+    speech_data = list()
+    for item in llm_extract(text, roster, info, cancelled):
+        speech_data.append(item)
+        yield item
+    # Only reached if the whole response was read, so partial extractions are never cached.
+    if cancelled is not None and cancelled.is_set():
+        return
+    extraction_cache.put(cache_key, speech_data)
+    quote_fast_path.record(local_extraction, speech_data)
+
+def llm_extract(text, roster:Roster, info:dict, cancelled:threading.Event=None):
+    # Only the parts around the quotes are sent, and whatever comes back is checked against the original text.
+    compacted = compact_text(text, prompt_compaction_window) if prompt_compaction_window is not None else CompactText(text, [(0, len(text))])
+    info["input_tokens"] = estimate_tokens(text)
+    info["prompt_tokens"] = estimate_tokens(compacted.text)
+    info["saved_tokens"] = compacted.saved_tokens
+    if compacted.saved_tokens > 0:
+        print(f"Compacted the message from {len(text)} to {len(compacted.text)} characters (~{compacted.saved_tokens} tokens saved).")
+    try:
+        for item in dialog_extractor.stream_dialog(compacted.text, roster, cancelled):
+            item = compacted.verify(item)
+            if item is not None:
+                yield item
+    except Exception:
+        api_errors_total.inc(operation="extraction")
+        raise
+    info["repaired_lines"] = compacted.repaired
+    info["rejected_lines"] = compacted.rejected
+
+def compare_extraction(text, roster:Roster, local_extraction):
+    #Runs in the background, so the locally extracted message is already playing.
+    try:
+        speech_data = list(llm_extract(text, roster, dict()))
+    except Exception as e:
+        print(f"Could not compare the local extraction: {e}")
+        return
+    extraction_cache.put(ExtractionCache.make_key(text, roster.fingerprint, dialog_extractor.model, extraction_prompt_version), speech_data)
+    if not quote_fast_path.record(local_extraction, speech_data):
+        print(f"The local extraction (confidence {local_extraction.confidence:.2f}) disagreed with the LLM.")
+
+def get_voice(character:str, roster:Roster) -> tuple:
+    #The character names are constrained by the tool schema, so this is almost always an exact lookup. Fuzzy matching is only a fallback.
+    name = roster.resolve(character)
+    voice_id = roster.voices[name].get("id") if name is not None else None
+    if voice_id is None:
+        return None, None
+    try:
+        return voice_id, speech_synthesizer.get_voice(voice_id)
+    except Exception:
+        api_errors_total.inc(operation="voice_lookup")
+        raise
+
+def start_server(host:str=None, port:int=None) -> SpeakerServer:
+    global http_server
+    http_server = SpeakerServer(flask_app, host=server_host if host is None else host, port=flask_port if port is None else port, threads=server_threads,
+                                max_request_bytes=max_request_mb*1024*1024)
+    http_server.start()
+    return http_server
+
+def stop_server():
+    #Stops taking new jobs, waits for the running ones (up to shutdown_timeout) and then stops the HTTP server.
+    if http_server is not None:
+        http_server.stop(drain=job_queue.drain if job_queue is not None else None, timeout=shutdown_timeout)
+
+def prewarm_voices(roster:Roster):
+    #Fetches the voices as soon as they're picked, so the first request doesn't have to.
+    if speech_synthesizer is not None:
+        speech_synthesizer.prewarm([data.get("id") for data in roster.voices.values() if data.get("id") is not None])
+
+roster_holder.add_listener(prewarm_voices)
+
+def start_services(extractor:DialogExtractor, synthesizer:SpeechSynthesizer, sink:AudioSink):
+    #Sets up the backends and the processing stages. Must be called before the server starts handling requests.
+    global dialog_extractor, speech_synthesizer, audio_sink, player, synthesis_scheduler, history_janitor, job_queue, prefetcher, prefetch_extraction_budget
+    dialog_extractor = ChunkedExtractor(extractor, chunk_chars=extraction_chunk_chars, overlap_chars=extraction_chunk_overlap_chars,
+                                        max_parallel=extraction_max_parallel_chunks)
+    speech_synthesizer = synthesizer
+    audio_sink = sink
+    player = Player(audio_sink.play, line_gap=line_gap, speaker_change_gap=speaker_change_gap, stop_func=audio_sink.stop)
+    synthesis_scheduler = SynthesisScheduler(max_concurrent_generations)
+    delete_history_item = tracer.wrap("history_cleanup", speech_synthesizer.delete_history_item, on_error=lambda e: api_errors_total.inc(operation="history_cleanup"))
+    history_janitor = HistoryJanitor(delete_history_item, retention=history_retention_hours*3600 if history_retention_hours is not None else None,
+                                     state_file=history_janitor_file)
+    job_queue = jobs.JobQueue(process_job, workers=job_workers, on_finished=job_finished)
+    if prefetch_enabled:
+        prefetch_extraction_budget = CharacterBudget(prefetch_extractions_per_hour)
+        prefetcher = Prefetcher(prefetch_message, is_busy=lambda: job_queue.active() > 0, chars_per_hour=prefetch_chars_per_hour,
+                                max_pending=prefetch_max_pending)
+    prewarm_voices(roster_holder.current)
+
+def job_finished(job:jobs.Job):
+    record_job_metrics(job)
+    if job.options.get("client_stream") is not None:
+        job.options["client_stream"].finish(job)
+
+def record_job_metrics(job:jobs.Job):
+    jobs_total.inc(state=job.state)
+    job_seconds.observe(job.finished_at - job.created_at)
+    if "first_audio" in job.events:
+        time_to_first_audio_seconds.observe(job.events["first_audio"])
+
+def synthesize_and_cache(voice, text:str, cache_key:str, previous_ids:list[str]) -> bytes:
+    #Generates a line that wasn't in the cache, and caches it. previous_ids (the voice's earlier request IDs) are used for request stitching.
+    result = speech_synthesizer.synthesize(voice, text, previous_ids)
+    characters_synthesized_total.inc(len(text))
+    if result.request_id is not None:
+        previous_ids.append(result.request_id)
+    history_janitor.add(result.history_item_id)
+    audio_cache.put(cache_key, result.audio)
+    return result.audio
+
+def prefetch_message(text:str, roster:Roster, budget):
+    #Runs on the prefetcher. The first lines are generated into the audio cache while the rest is extracted,
+    #and the whole extraction is read so it gets cached too.
+    with tracer.span("prefetch", characters=len(text)) as span:
+        request_ids = dict()
+        generations = dict()    #Voice -> its last generation, so each voice's lines are generated in order (for stitching)
+        span["lines"] = 0
+
+        def allow_llm():
+            if prefetch_extraction_budget.try_spend(1):
+                return True
+            span["over_extraction_budget"] = True
+            return False
+
+        info = dict()
+        for item in extract_dialog(text, roster, info=info, allow_llm=allow_llm):
+            if span["lines"] >= prefetch_warm_lines or span.get("over_budget"):
+                continue
+            voice_id, voice = get_voice(item.get("character"), roster)
+            if voice is None:
+                continue
+            line_text = text_changes.apply(item.get("text"))
+            cache_key = AudioCache.make_key(voice_id, speech_synthesizer.model_id, speech_synthesizer.options, line_text)
+            span["lines"] += 1
+            if audio_cache.get(cache_key) is not None:
+                continue
+            if not budget.try_spend(len(line_text)):
+                span["over_budget"] = True
+                continue
+            generations[voice_id] = synthesis_scheduler.submit(prefetch_line, voice, line_text, cache_key, request_ids.setdefault(voice_id, []),
+                                                               after=generations.get(voice_id))
+        span["method"] = info.get("method")
+        for generation in generations.values():
+            generation.result()
+
+def prefetch_line(voice, text:str, cache_key:str, previous_ids:list[str]):
+    try:
+        synthesize_and_cache(voice, text, cache_key, previous_ids)
+    except Exception:
+        api_errors_total.inc(operation="synthesis")
+        raise
+    lines_total.inc(source="prefetch")
+
+def process_job(job:jobs.Job, job_player:Player=None):
+    #job_player replaces the shared player (used to render to files, or to stream the audio to the client, instead of playing it).
+    if job_player is None and job.options.get("client_stream") is not None:
+        job_player = job.options["client_stream"].player
+    roster = job.roster
+    request_ids = dict()
+    shown_lines = list()
+    playback_starts = dict()
+
+    def synthesize(line:SpeechLine) -> bytes:
+        with tracer.span("synthesis", job, line=line.index, characters=len(line.text)) as span:
+            cache_key = AudioCache.make_key(line.voice_key, speech_synthesizer.model_id, speech_synthesizer.options, line.text)
+            audio = audio_cache.get(cache_key)
+            cache_requests_total.inc(cache="audio", result="hit" if audio is not None else "miss")
+            span["cached"] = audio is not None
+            if audio is not None:
+                line.cached = True
+                lines_total.inc(source="cache")
+                job.mark("first_synthesized")
+                return audio
+            try:
+                return synthesize_audio(line, cache_key)
+            except Exception:
+                api_errors_total.inc(operation="synthesis")
+                raise
+
+    def synthesize_audio(line:SpeechLine, cache_key:str) -> bytes:
+        audio = synthesize_and_cache(line.voice, line.text, cache_key, request_ids.setdefault(line.voice_key, []))
+        lines_total.inc(source="api")
+        job.mark("first_synthesized")
+        return audio
+
+    def on_playback_start():
+        job.mark("first_audio")
+        job.set_state(jobs.PLAYING)
+
+    def on_line_start(line:SpeechLine):
+        playback_starts[line.index] = (time.time(), time.perf_counter())
+        shown_lines.append(f"{line.character}: {line.text}")
+        if show_lines is not None:
+            show_lines("\n\n".join(shown_lines))
+
+    def on_line_end(line:SpeechLine):
+        start_time, start = playback_starts.pop(line.index)
+        tracer.record("playback", time.perf_counter() - start, start_time, job, {"line": line.index})
+
+    speech_pipeline = SpeechPipeline(job_player if job_player is not None else player, synthesis_scheduler, synthesize, prefetch=prefetch_lines, per_voice=max_generations_per_voice,
+                                     on_playback_start=on_playback_start, on_line_start=on_line_start, on_line_end=on_line_end)
+    # If the message is being prefetched right now, wait for it instead of doing the same work twice.
+    if prefetcher is not None:
+        with tracer.span("prefetch_wait", job) as span:
+            span["waited"] = prefetcher.claim(request_key(job.text, roster))
+    # Cancelling stops the playback and drops the lines that aren't generated yet, and the extraction stops at the next line.
+    job.add_cancel_callback(speech_pipeline.cancel)
+    job.set_state(jobs.EXTRACTING)
+    try:
+        with tracer.span("extraction", job) as extraction_span:
+            for item in extract_dialog(job.text, roster, use_cache=not job.options.get("bypass_extraction_cache"), info=job.extraction,
+                                       cancelled=job.cancel_event):
+                if job.cancelled:
+                    break
+                print(item)
+                if job.state == jobs.EXTRACTING:
+                    job.mark("first_line")
+                    job.set_state(jobs.SYNTHESIZING)
+                character = item.get("character")
+                with tracer.span("voice_resolution", job, character=character):
+                    voice_id, voice = get_voice(character, roster)
+                if voice is None:
+                    print(f"Voice not found, skipping text '{item.get('text')}'")
+                    continue
+                print(f"Character: {character}, Voice: {voice_id}, Text: {item.get('text')}")
+                with tracer.span("text_changes", job):
+                    text = text_changes.apply(item.get("text"))
+                speech_pipeline.add_line(character, text, voice, voice_key=voice_id)
+            extraction_span["method"] = job.extraction.get("method")
+            extraction_span["lines"] = speech_pipeline.line_count
+        job.mark("extraction_done")
+    finally:
+        speech_pipeline.finish()
+
+    try:
+        speech_pipeline.wait()
+    except Exception:
+        if not job.cancelled:
+            raise
+    if job.cancelled:
+        job.set_state(jobs.CANCELLED, "Cancelled.")
+    elif speech_pipeline.line_count == 0:
+        job.set_state(jobs.DONE, "No dialog found.")
+    else:
+        job.set_state(jobs.DONE, "Audio generation successful.")
+
+
+def get_argument(name:str, default=None):
+    #The value after the given flag, if it's on the command line.
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def create_api_clients(openai_api_key:str, elevenlabs_api_key:str, elevenlabs_model:str):
+    #Raises if a key is invalid (openai.AuthenticationError or ValueError).
+    from elevenlabslib import User, GenerationOptions
+    import httpx
+    import openai
+    startup_profile.mark("import elevenlabslib, openai")
+    openai_client = openai.Client(api_key=openai_api_key, max_retries=0,
+                                  http_client=openai.DefaultHttpxClient(limits=httpx.Limits(max_connections=openai_max_concurrent*2, max_keepalive_connections=openai_max_concurrent)))
+    elevenlabs_user = User(elevenlabs_api_key)
+    generation_options = GenerationOptions(model_id=elevenlabs_model, latencyOptimizationLevel=1)
+    api_providers["openai"] = ProviderClient("openai", max_concurrent=openai_max_concurrent, pool_size=openai_max_concurrent, max_attempts=api_max_attempts)
+    api_providers["elevenlabs"] = ProviderClient("elevenlabs", max_concurrent=elevenlabs_max_concurrent, pool_size=elevenlabs_max_concurrent*2, max_attempts=api_max_attempts)
+    return openai_client, elevenlabs_user, generation_options
+
+def start_api_services(openai_client, elevenlabs_user, generation_options, sink:AudioSink):
+    start_services(OpenAIExtractor(openai_client, extraction_model, api_providers["openai"]),
+                   ElevenLabsSynthesizer(elevenlabs_user, generation_options, api_providers["elevenlabs"]), sink)
+
+def get_saved_key(name:str, environment_variable:str=None) -> str | None:
+    #The environment variable if it's set, otherwise what the GUI saved to the keyring (servers often don't have a keyring at all).
+    if environment_variable is not None and os.environ.get(environment_variable):
+        return os.environ[environment_variable]
+    try:
+        return keyring.get_password("gpt_speaker", name)
+    except keyring.errors.KeyringError:
+        return None
+
+def run_headless():
+    #No Qt at all: the keys come from the environment (or the ones the GUI saved), and the roster from the roster file.
+    openai_api_key = get_saved_key("openai_api_key", "OPENAI_API_KEY")
+    elevenlabs_api_key = get_saved_key("elevenlabs_api_key", "ELEVENLABS_API_KEY")
+    elevenlabs_model = get_saved_key("elevenlabs_model", "ELEVENLABS_MODEL") or "eleven_multilingual_v2"
+    if not openai_api_key or not elevenlabs_api_key:
+        sys.exit("No API keys found. Set OPENAI_API_KEY and ELEVENLABS_API_KEY, or run the GUI once to save them.")
+    openai_client, elevenlabs_user, generation_options = create_api_clients(openai_api_key, elevenlabs_api_key, elevenlabs_model)
+    startup_profile.mark("API clients")
+
+    try:
+        sink = SpeakerSink(audio_format=generation_options)
+    except Exception as e:
+        #No sound device (or no PortAudio), requests can still use client playback.
+        print(f"No local audio playback ({type(e).__name__}: {e}), only \"playback\": \"client\" requests will be heard.")
+        sink = NullSink()
+    start_api_services(openai_client, elevenlabs_user, generation_options, sink)
+    roster_file.watch()
+    start_server()
+    startup_profile.mark("Services, roster and HTTP server")
+    startup_profile.report("Startup")
+    print(f"GPT_Speaker running headless on {server_host}:{flask_port}, roster from {roster_file.path}.")
+
+    # SIGTERM (service managers) and Ctrl+C both shut down gracefully.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=stop_server).start())
+    try:
+        http_server.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_server()
+
+def run_gui():
+    global show_lines
+    from PyQt6.QtGui import QIcon
+    from PyQt6.QtWidgets import QApplication
+    import gui
+    startup_profile.mark("import PyQt6, gui")
     if os.name == "nt":
         import ctypes
         myappid = u'lugia19.GPT_Speakerv3'
         ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
     gui_app = QApplication(sys.argv)
-    gui_app.setWindowIcon(QIcon(logo_path))
+    gui_app.setWindowIcon(QIcon(gui.logo_path))
     gui_app.setStyleSheet(helper.get_stylesheet())
+    startup_profile.mark("Qt application")
+    import openai
     while True:
-        keys = AskKeys()
+        keys = gui.AskKeys()
         return_code = keys.exec()
         if return_code != 0:
             os._exit(1) #Please just explode.
@@ -365,27 +713,37 @@ if __name__ == '__main__':
         elevenlabs_api_key = keys.elevenlabs_api_key.get_value()
         elevenlabs_model = keys.elevenlabs_model.get_value()
         try:
-            openai_client = openai.Client(api_key=openai_api_key)
-            elevenlabs_user = User(elevenlabs_api_key)
+            openai_client, elevenlabs_user, generation_options = create_api_clients(openai_api_key, elevenlabs_api_key, elevenlabs_model)
             break
         except (openai.AuthenticationError,ValueError):
             print("API key error!")
             pass
 
+    startup_profile.mark("API keys dialog", waiting=True)
     keyring.set_password("gpt_speaker", "elevenlabs_api_key", elevenlabs_api_key)
     keyring.set_password("gpt_speaker", "openai_api_key", openai_api_key)
     keyring.set_password("gpt_speaker", "elevenlabs_model", elevenlabs_model)
+    startup_profile.mark("API clients")
 
-    generation_options = GenerationOptions(model_id=elevenlabs_model, latencyOptimizationLevel=1)
+    # The server is up before the window, requests are answered as soon as there are voices.
+    start_api_services(openai_client, elevenlabs_user, generation_options, SpeakerSink(audio_format=generation_options))
+    roster_file.watch()
+    start_server()
+    startup_profile.mark("Services, roster and HTTP server")
 
-    ex = VoicePickerUI()
+    ex = gui.VoicePickerUI(elevenlabs_user, roster_file, voice_list_file, on_stop=cancel_local_jobs, startup_profile=startup_profile)
+    show_lines = ex.show_lines
     ex.trayIcon.show()
-    flask_thread = threading.Thread(target=flask_app.run, kwargs={'host':'127.0.0.1', 'port':flask_port})
-    flask_thread.start()
-
-
     ex.show()
+    startup_profile.mark("Voice picker window")
+    startup_profile.report("Startup")
     gui_app.exec()
 
-    requests.get(f"http://localhost:{flask_port}/stopServer")   #Kill the flask server
-    flask_thread.join()
+    stop_server()
+
+if __name__ == '__main__':
+    roster_file = RosterFile(get_argument("--roster", roster_file_path), roster_holder)
+    if "--headless" in sys.argv:
+        run_headless()
+    else:
+        run_gui()
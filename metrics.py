@@ -0,0 +1,173 @@
+"""
+Metrics in the Prometheus text format, and per-job tracing.
+Kept dependency-free: there are only a few metric types, and they're all simple.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(label_names:tuple, label_values:tuple, extra:str=None) -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+def _format_value(value:float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """
+    If func is given, it's called on every scrape to get the value(s) instead, returning either a number,
+    or a dict of label value tuples -> number. Useful for values something else already keeps track of.
+    """
+    type = None
+
+    def __init__(self, name:str, help_text:str, labels:tuple=(), func:Callable=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.func = func
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def _key(self, labels:dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self) -> list[str]:
+        if self.func is not None:
+            value = self.func()
+            with self._lock:
+                self._values = dict(value) if isinstance(value, dict) else {(): value}
+        output = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                output.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return output
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value:float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name:str, help_text:str, labels:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            #Bucket counts, sum, and the number of observations (which includes the ones above the last bucket).
+            counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def render(self) -> list[str]:
+        output = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, (counts, total, observations) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets + (float("inf"),), counts + [observations]):
+                    le_label = 'le="' + _format_value(float(bound)) + '"'
+                    output.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le_label)} {count}")
+                output.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+                output.append(f"{self.name}_count{_format_labels(self.label_names, key)} {observations}")
+        return output
+
+class Registry:
+    def __init__(self):
+        self._metrics = list()
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name:str, help_text:str, labels:tuple=(), func:Callable=None) -> Counter:
+        return self._add(Counter(name, help_text, labels, func))
+
+    def gauge(self, name:str, help_text:str, labels:tuple=(), func:Callable=None) -> Gauge:
+        return self._add(Gauge(name, help_text, labels, func))
+
+    def histogram(self, name:str, help_text:str, labels:tuple=(), buckets:tuple=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        output = list()
+        for metric in self._metrics:
+            output.extend(metric.render())
+        return "\n".join(output) + "\n"
+
+class Tracer:
+    """
+    Times the stages of a job (spans). Every span is observed in a per-stage latency histogram, added to the job
+    (if there is one) so it shows up in /jobs/<id>, and written to the trace log (if set) as a JSON line.
+    Arguments:
+        registry: Where the stage histogram is registered.
+        log_file: The JSON-lines trace log. None disables it.
+    """
+    def __init__(self, registry:Registry, log_file:str=None):
+        self.log_file = log_file
+        self.stage_seconds = registry.histogram("gpt_speaker_stage_seconds", "Time spent in each processing stage.", labels=("stage",))
+        self._log_lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage:str, job=None, **attributes):
+        #The attributes dict is yielded, so the traced code can add to it.
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = repr(e)
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, start_time, job, attributes)
+
+    def record(self, stage:str, duration:float, start_time:float, job=None, attributes:dict=None):
+        self.stage_seconds.observe(duration, stage=stage)
+        span = {"span": stage, "duration": round(duration, 4)}
+        if job is not None:
+            span["start"] = round(start_time - job.created_at, 4)   #Seconds since the job was created
+        if attributes:
+            span.update(attributes)
+        if job is not None:
+            job.add_span(span)
+        if self.log_file is not None:
+            entry = dict(span, time=start_time, job_id=job.id if job is not None else None)
+            with self._log_lock:
+                with open(self.log_file, "a", encoding="utf8") as fp:
+                    fp.write(json.dumps(entry) + "\n")
+
+    def wrap(self, stage:str, func:Callable, on_error:Callable[[Exception], None]=None) -> Callable:
+        #Traces every call of func (for background work that isn't part of a job).
+        def traced(*args, **kwargs):
+            with self.span(stage):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(e)
+                    raise
+        return traced
@@ -0,0 +1,294 @@
+import json
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Future
+from typing import Callable, Optional, Any
+
+class SpeechDataParser:
+    """
+    Incrementally parses the arguments of the 'speak' tool call as they're streamed in.
+    Every time an item of the speech_data array is complete, it's returned by feed(), so it can be synthesized
+    without waiting for the rest of the response.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item_start = None
+
+    def feed(self, chunk:str) -> list[dict]:
+        self.buffer += chunk
+        items = []
+        while self._pos < len(self.buffer):
+            char = self.buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                # Depth 1 is the arguments object, depth 2 is the speech_data array, so items start at depth 2.
+                if char == "{" and self._depth == 2:
+                    self._item_start = self._pos
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._depth == 2 and self._item_start is not None:
+                    try:
+                        items.append(json.loads(self.buffer[self._item_start:self._pos + 1]))
+                    except json.JSONDecodeError:
+                        print(f"Could not parse speech item {self.buffer[self._item_start:self._pos + 1]}")
+                    self._item_start = None
+            self._pos += 1
+        return items
+
+class SynthesisScheduler:
+    """
+    Runs the generations of every pipeline, limiting how many of them can happen at the same time.
+    Arguments:
+        max_concurrent: The maximum number of generations running at once.
+    """
+    def __init__(self, max_concurrent:int=3):
+        self._semaphore = threading.BoundedSemaphore(max(1, max_concurrent))
+
+    def submit(self, func:Callable[..., Any], *args, after:Optional[Future]=None) -> Future:
+        #Runs func(*args) once a slot is free. If after is given, it also waits for that future to be done first.
+        future = Future()
+
+        def wrapper():
+            if after is not None:
+                futures.wait([after])
+            with self._semaphore:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        threading.Thread(target=wrapper, daemon=True).start()
+        return future
+
+class _Playlist:
+    #The lines of a single pipeline, in playback order. The window limits how many lines can be synthesized ahead of playback.
+    END = object()
+
+    def __init__(self, prefetch:int, on_start:Callable[[], Any] = None, on_item_start:Callable[[Any], Any] = None,
+                 on_item_end:Callable[[Any], Any] = None):
+        self.queue = queue.Queue()
+        self.window = threading.Semaphore(max(1, prefetch) + 1)
+        self.on_start = on_start
+        self.on_item_start = on_item_start
+        self.on_item_end = on_item_end
+        self.done = threading.Event()
+        self._cancelled = Future()  #A future so the player can wait on it together with a line's audio
+
+    def cancel(self):
+        if not self._cancelled.done():
+            self._cancelled.set_result(True)
+
+    @property
+    def cancelled(self) -> bool:
+        #The remaining lines are skipped.
+        return self._cancelled.done()
+
+class Player:
+    """
+    The single playback stage. Pipelines hand it their playlists, which are played one after the other in the order they were added.
+    Arguments:
+        play_func: Takes a SpeechLine and its audio and plays it, blocking until it's done.
+        line_gap: Seconds of silence between two lines of the same character.
+        speaker_change_gap: Seconds of silence between two lines of different characters.
+        gap_func: Produces the silence between lines, given its length. Waits by default (rendering to a file writes silence instead).
+        stop_func: Interrupts play_func, making it return early. Used when a playlist is cancelled halfway through a line.
+    """
+    def __init__(self, play_func:Callable[[Any, Any], None], line_gap:float=0.5, speaker_change_gap:float=0.5,
+                 gap_func:Callable[[float], None]=time.sleep, stop_func:Callable[[], None]=None):
+        self.play_func = play_func
+        self.gap_func = gap_func
+        self.stop_func = stop_func
+        self._current:Optional[_Playlist] = None
+        self._current_lock = threading.Lock()
+        self.line_gap = line_gap
+        self.speaker_change_gap = speaker_change_gap
+        self._playlists = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="player")
+        self._thread.start()
+
+    def add(self, playlist:_Playlist):
+        self._playlists.put(playlist)
+
+    def cancel(self, playlist:_Playlist):
+        #Skips the rest of the playlist, stopping the line that's playing if it's from this playlist.
+        with self._current_lock:
+            playlist.cancel()
+            playing = self._current is playlist
+        if playing and self.stop_func is not None:
+            self.stop_func()
+
+    def stop(self):
+        #Ends the playback thread once the playlists that were already added are done. Only for players made for a single job.
+        self._playlists.put(None)
+
+    def _loop(self):
+        while True:
+            playlist = self._playlists.get()
+            if playlist is None:
+                return
+            previous_line = None
+            try:
+                while True:
+                    line = playlist.queue.get()
+                    if line is _Playlist.END:
+                        break
+                    # A cancelled playlist doesn't wait for the generations that are still running.
+                    futures.wait([line.future, playlist._cancelled], return_when=futures.FIRST_COMPLETED)
+                    try:
+                        audio = line.future.result() if line.future.done() else None
+                    except Exception:
+                        # The pipeline already recorded the error, just skip the line.
+                        audio = None
+                    if audio is None or playlist.cancelled:
+                        playlist.window.release()
+                        continue
+
+                    if previous_line is None:
+                        if playlist.on_start is not None:
+                            playlist.on_start()
+                    else:
+                        self.gap_func(self.line_gap if previous_line.character == line.character else self.speaker_change_gap)
+                    if playlist.on_item_start is not None:
+                        playlist.on_item_start(line)
+                    with self._current_lock:
+                        self._current = None if playlist.cancelled else playlist
+                        play = self._current is not None
+                    if play:
+                        self.play_func(line, audio)
+                    with self._current_lock:
+                        self._current = None
+                    if playlist.on_item_end is not None:
+                        playlist.on_item_end(line)
+                    previous_line = line
+                    playlist.window.release()
+            except Exception:
+                traceback.print_exc()
+                # Drain whatever is left so the pipeline doesn't block forever.
+                while True:
+                    playlist.window.release()
+                    if playlist.queue.get() is _Playlist.END:
+                        break
+            finally:
+                playlist.done.set()
+
+class SpeechLine:
+    def __init__(self, index:int, character:str, text:str, voice:Any, voice_key:str):
+        self.index = index
+        self.character = character
+        self.text = text
+        self.voice = voice
+        self.voice_key = voice_key
+        self.future:Optional[Future] = None
+        self.cached = False
+        self.synthesis_time:Optional[float] = None
+
+class SpeechPipeline:
+    """
+    Synthesis and playback for one job.
+    Lines are added with add_line() as soon as they're extracted. Lines for different voices are synthesized concurrently,
+    but are always played back in the order they were added.
+    Arguments:
+        player: The Player that will play the audio.
+        scheduler: The SynthesisScheduler the generations are run on.
+        synthesize: Takes a SpeechLine and returns its audio.
+        prefetch: How many lines can be synthesized ahead of the one that's currently playing.
+        per_voice: How many lines of the same voice can be synthesized at the same time. With 1, each voice's lines are generated in order.
+        on_playback_start: Called when the first line of this pipeline starts playing.
+        on_line_start: Called with the SpeechLine every time a line starts playing.
+        on_line_end: Called with the SpeechLine every time a line is done playing.
+    """
+    def __init__(self, player:Player, scheduler:SynthesisScheduler, synthesize:Callable[[SpeechLine], Any], prefetch:int=3, per_voice:int=1,
+                 on_playback_start:Callable[[], Any] = None, on_line_start:Callable[[SpeechLine], Any] = None,
+                 on_line_end:Callable[[SpeechLine], Any] = None):
+        self.scheduler = scheduler
+        self.synthesize = synthesize
+        self.per_voice = max(1, per_voice)
+        self.error:Optional[BaseException] = None
+        self.line_count = 0
+        self.cancelled = False
+        self._player = player
+        self._lines = queue.Queue()
+        self._lanes = dict()
+        self._dispatched = deque()
+        self._playlist = _Playlist(prefetch, on_start=on_playback_start, on_item_start=on_line_start, on_item_end=on_line_end)
+        player.add(self._playlist)
+        self._thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._thread.start()
+
+    def add_line(self, character:str, text:str, voice:Any, voice_key:str=None) -> SpeechLine:
+        line = SpeechLine(self.line_count, character, text, voice, voice_key if voice_key is not None else character)
+        self.line_count += 1
+        self._lines.put(line)
+        return line
+
+    def finish(self):
+        #No more lines will be added.
+        self._lines.put(None)
+
+    def cancel(self):
+        #Stops the playback and drops every line that isn't synthesized yet. Generations that already started still finish (and get cached).
+        self.cancelled = True
+        for line in list(self._dispatched):
+            line.future.cancel()
+        self._player.cancel(self._playlist)
+
+    def wait(self, timeout:float=None) -> bool:
+        #Waits until everything has been played. Re-raises the first synthesis error, if there was one.
+        finished = self._playlist.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return finished
+
+    def _synthesize(self, line:SpeechLine):
+        start = time.perf_counter()
+        try:
+            return self.synthesize(line)
+        except Exception as e:
+            traceback.print_exc()
+            if self.error is None:
+                self.error = e
+            raise
+        finally:
+            line.synthesis_time = time.perf_counter() - start
+
+    def _dispatch_loop(self):
+        try:
+            while True:
+                line = self._lines.get()
+                if line is None:
+                    break
+                if self.cancelled:
+                    continue
+                self._playlist.window.acquire()
+                # Each voice gets a lane, and a line can only start once the line per_voice places before it in the same lane is done.
+                lane = self._lanes.setdefault(line.voice_key, deque(maxlen=self.per_voice))
+                after = lane[0] if len(lane) == self.per_voice else None
+                line.future = self.scheduler.submit(self._synthesize, line, after=after)
+                lane.append(line.future)
+                while len(self._dispatched) > 0 and self._dispatched[0].future.done():
+                    self._dispatched.popleft()
+                self._dispatched.append(line)
+                if self.cancelled:
+                    line.future.cancel()
+                self._playlist.queue.put(line)
+        finally:
+            self._playlist.queue.put(_Playlist.END)
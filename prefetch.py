@@ -0,0 +1,135 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from typing import Any, Callable
+
+class CharacterBudget:
+    """
+    How many characters can be spent in any rolling hour (or anything else counted the same way, like extractions).
+    Arguments:
+        chars_per_hour: The budget. None means unlimited.
+        window: The length of the rolling window, in seconds.
+    """
+    def __init__(self, chars_per_hour:int=None, window:float=3600):
+        self.chars_per_hour = chars_per_hour
+        self.window = window
+        self._spent = deque()  #(time, characters)
+        self._lock = threading.Lock()
+
+    def _expire(self, now:float):
+        while len(self._spent) > 0 and self._spent[0][0] <= now - self.window:
+            self._spent.popleft()
+
+    def remaining(self) -> float:
+        if self.chars_per_hour is None:
+            return float("inf")
+        with self._lock:
+            self._expire(time.monotonic())
+            return self.chars_per_hour - sum(characters for _, characters in self._spent)
+
+    def try_spend(self, characters:int) -> bool:
+        #Spends the characters if they fit in the budget, returns whether they did.
+        if self.chars_per_hour is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if sum(spent for _, spent in self._spent) + characters > self.chars_per_hour:
+                return False
+            self._spent.append((now, characters))
+            return True
+
+class Prefetcher:
+    """
+    Speculative work for messages that will probably be played soon, done on a single low-priority worker:
+    nothing is started while is_busy() is true, and only the newest max_pending messages are kept waiting.
+    When a message is actually requested, claim() makes sure the work isn't done twice.
+    Arguments:
+        handler: Does the work, handler(text, roster, budget). Should spend from the budget before every generation.
+        is_busy: Returns whether real requests are being processed.
+        chars_per_hour: The budget for the generated characters. None means unlimited.
+        max_pending: How many messages can be waiting. The oldest ones are dropped.
+        remember: How many finished messages are remembered, so sending the same one again doesn't redo it.
+    """
+    def __init__(self, handler:Callable[[str, Any, CharacterBudget], None], is_busy:Callable[[], bool]=None, chars_per_hour:int=None,
+                 max_pending:int=5, remember:int=200):
+        self.handler = handler
+        self.is_busy = is_busy if is_busy is not None else (lambda: False)
+        self.budget = CharacterBudget(chars_per_hour)
+        self.max_pending = max_pending
+        self.remember = remember
+        self._pending = OrderedDict()   #key -> (text, roster)
+        self._done = OrderedDict()
+        self._running_key = None
+        self._running_done = threading.Event()
+        self._condition = threading.Condition()
+        self._stats = {"queued": 0, "done": 0, "dropped": 0, "claimed": 0, "over_budget": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="prefetcher")
+        self._thread.start()
+
+    def submit(self, key:str, text:str, roster) -> str:
+        #Returns what happened: "queued", "duplicate" (already queued, running or done) or "over_budget".
+        with self._condition:
+            if key in self._pending or key in self._done or key == self._running_key:
+                return "duplicate"
+            if self.budget.remaining() <= 0:
+                self._stats["over_budget"] += 1
+                return "over_budget"
+            self._pending[key] = (text, roster)
+            self._stats["queued"] += 1
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self._stats["dropped"] += 1
+            self._condition.notify_all()
+        return "queued"
+
+    def claim(self, key:str, timeout:float=10) -> bool:
+        """
+        Called when the message is really requested. If it's still waiting it's dropped (the request does the work itself),
+        and if it's being prefetched right now, this waits for it (up to timeout) so the request gets the cached results.
+        Returns whether it waited for it.
+        """
+        with self._condition:
+            if self._pending.pop(key, None) is not None:
+                self._stats["claimed"] += 1
+                return False
+            if self._running_key != key:
+                return False
+            running_done = self._running_done
+            self._stats["claimed"] += 1
+        return running_done.wait(timeout)
+
+    def stats(self) -> dict:
+        with self._condition:
+            stats = dict(self._stats, pending=len(self._pending))
+        stats["budget_remaining"] = self.budget.remaining() if self.budget.chars_per_hour is not None else None
+        return stats
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+            # Real requests go first.
+            while self.is_busy():
+                time.sleep(0.2)
+            with self._condition:
+                if len(self._pending) == 0:
+                    continue
+                key, (text, roster) = self._pending.popitem(last=True)    #Newest first, it's the most likely to be played
+                self._running_key = key
+                self._running_done = threading.Event()
+            try:
+                self.handler(text, roster, self.budget)
+                stat = "done"
+            except Exception:
+                traceback.print_exc()
+                stat = "failed"
+            with self._condition:
+                self._stats[stat] += 1
+                self._done[key] = True
+                while len(self._done) > self.remember:
+                    self._done.popitem(last=False)
+                self._running_key = None
+                self._running_done.set()
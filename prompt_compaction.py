@@ -0,0 +1,122 @@
+import difflib
+import re
+import threading
+from typing import Optional
+
+from quote_extractor import QUOTE_REGEX
+
+SEPARATOR = "\n…\n"
+
+def estimate_tokens(text:str) -> int:
+    #Roughly 4 characters per token for English text, good enough to report the savings.
+    return (len(text) + 3) // 4
+
+class CompactText:
+    """
+    The parts of a message the extractor actually needs: the quotes, plus some text around them for the attributions.
+    Keeps a map from offsets in the compacted text to offsets in the original, so the extracted lines can be checked
+    against (and repaired from) the original text.
+    Arguments:
+        original: The full message.
+        segments: (start, end) spans of the original that are kept, in order and not overlapping.
+    """
+    def __init__(self, original:str, segments:list[tuple[int, int]]):
+        self.original = original
+        self.segments = list()  #(compact start, original start, length)
+        parts = list()
+        position = 0
+        for start, end in segments:
+            if len(parts) > 0:
+                parts.append(SEPARATOR)
+                position += len(SEPARATOR)
+            self.segments.append((position, start, end - start))
+            parts.append(original[start:end])
+            position += end - start
+        self.text = "".join(parts)
+        self.repaired = 0
+        self.rejected = 0
+        self._quotes = None
+        self._lock = threading.Lock()
+
+    @property
+    def saved_tokens(self) -> int:
+        return estimate_tokens(self.original) - estimate_tokens(self.text)
+
+    def to_original(self, start:int, end:int) -> Optional[tuple[int, int]]:
+        #Maps a span of the compacted text back to the original. None if it isn't inside a single segment.
+        for compact_start, original_start, length in self.segments:
+            if compact_start <= start and end <= compact_start + length:
+                return original_start + start - compact_start, original_start + end - compact_start
+        return None
+
+    def verify(self, item:dict) -> Optional[dict]:
+        """
+        Checks that an extracted line is really in the message. Lines that are there with small differences
+        (whitespace, punctuation, a word or two) are replaced with the original text, and lines that aren't there at all are dropped.
+        """
+        line = str(item.get("text", "")).strip()
+        if line == "":
+            return None
+
+        position = self.text.find(line)
+        span = self.to_original(position, position + len(line)) if position != -1 else None
+        if span is not None:
+            return item
+
+        # Same words, but different whitespace or punctuation.
+        words = re.findall(r"\w+", line)
+        match = re.search(r"\W+".join(re.escape(word) for word in words), self.original) if len(words) > 0 else None
+        if match is not None:
+            repaired = self.original[match.start():match.end()]
+        else:
+            # Otherwise, the closest quote (the model rephrased it a little).
+            best_ratio, repaired = 0, None
+            for quote in self._get_quotes():
+                ratio = difflib.SequenceMatcher(None, line.lower(), quote.lower()).ratio()
+                if ratio > best_ratio:
+                    best_ratio, repaired = ratio, quote
+            if best_ratio < 0.85:
+                print(f"Dropping a line that isn't in the message: '{line}'")
+                with self._lock:
+                    self.rejected += 1
+                return None
+
+        with self._lock:
+            self.repaired += 1
+        return dict(item, text=repaired)
+
+    def _get_quotes(self) -> list[str]:
+        if self._quotes is None:
+            self._quotes = [(match.group(1) if match.group(1) is not None else match.group(2)).strip() for match in QUOTE_REGEX.finditer(self.original)]
+        return self._quotes
+
+def compact_text(text:str, window_chars:int=150, min_savings:float=0.1) -> CompactText:
+    """
+    Keeps every quote plus up to window_chars of text on each side (cut at word boundaries), and drops the rest of the narration.
+    Returns the message unchanged if the quotes can't be found reliably, or the savings would be under min_savings.
+    """
+    unchanged = CompactText(text, [(0, len(text))])
+    if text.count('"') % 2 != 0 or text.count("“") != text.count("”"):
+        return unchanged
+    segments = list()
+    for match in QUOTE_REGEX.finditer(text):
+        start = max(0, match.start() - window_chars)
+        end = min(len(text), match.end() + window_chars)
+        if start > 0:
+            boundary = re.search(r"\s", text[start:match.start()])
+            start = start + boundary.end() if boundary is not None else match.start()
+        if end < len(text):
+            boundary = max(text.rfind(" ", match.end(), end), text.rfind("\n", match.end(), end))
+            end = boundary if boundary != -1 else match.end()
+        # Windows that overlap (or almost touch) are merged, so no quote or attribution gets cut.
+        if len(segments) > 0 and start <= segments[-1][1] + len(SEPARATOR):
+            segments[-1] = (segments[-1][0], max(segments[-1][1], end))
+        else:
+            segments.append((start, end))
+
+    if len(segments) == 0:
+        return unchanged
+    compacted = CompactText(text, segments)
+    if len(compacted.text) > len(text) * (1 - min_savings):
+        return unchanged
+    return compacted
@@ -0,0 +1,217 @@
+import json
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+from roster import Roster, normalize_name
+
+QUOTE_REGEX = re.compile(r'"([^"\n]+)"|“([^”\n]+)”')
+_SPEECH_VERBS = (r"said|says|asked|asks|replied|replies|answered|shouted|yelled|whispered|muttered|murmured|called|cried|exclaimed|"
+                 r"added|continued|snapped|growled|laughed|sighed|agreed|began|demanded|insisted|offered|told|warned|spoke")
+_WHO = r"(?P<who>[A-Z][\w'’-]*(?:\s+[A-Z][\w'’-]*)*|[Hh]e|[Ss]he|[Tt]hey|the\s+\w+)"
+_ADVERB = r"(?:\w+ly\s+)?"
+#"Hi," said Alice. / "Hi," Alice said.
+_AFTER_VERB_WHO = re.compile(rf"^[\s,.!?;:—–-]*{_ADVERB}(?i:{_SPEECH_VERBS})\s+{_WHO}")
+_AFTER_WHO_VERB = re.compile(rf"^[\s,.!?;:—–-]*{_WHO}\s+{_ADVERB}(?i:{_SPEECH_VERBS})\b")
+#Alice said, "Hi." / Alice: "Hi."
+_BEFORE_WHO_VERB = re.compile(rf"{_WHO}\s+{_ADVERB}(?i:{_SPEECH_VERBS})\b[^.!?\"“”]*[,:]?\s*$")
+_BEFORE_SCRIPT = re.compile(r"^\s*(?P<who>[A-Z][\w'’ -]*?)\s*:\s*$")
+_PRONOUN_GENDERS = {"he": "male", "she": "female", "they": None}
+#Capitalized words that start sentences without naming anyone. Any other capitalized word outside the quotes might be a
+#character without a voice (who the LLM would skip), so the only character isn't assumed to be the speaker.
+_NOT_NAMES = frozenset("""i i'm i'd i'll he she they it we you his her their its our your him them us me my this that these those
+there then the a an and but or so yet if when while as after before once until then now still just suddenly finally meanwhile
+later soon again yes no oh okay ok well what why how who where which not never""".split())
+
+#How sure the parser is about a line, depending on how the speaker was found.
+EXPLICIT = 1.0          #Named right next to the quote ("Hi," said Alice)
+CONTINUATION = 0.9      #Another quote in the same paragraph as an attributed one
+ONLY_CHARACTER = 0.9    #Only one character in the roster, the quote stands on its own as dialog, and nobody else is named
+PRONOUN = 0.8           #"she said", with only one character of that gender
+MENTIONED = 0.6         #The name appears near the quote, but not as an attribution
+GUESS = 0.3             #Nothing to go on, or attributed to someone without a voice
+
+class QuoteExtraction:
+    """
+    The result of parsing the quotes in a message locally.
+    Arguments:
+        lines: The extracted lines, as {"character": name, "text": line}, same as the LLM returns them.
+        confidence: How sure the parser is about the whole message (the lowest confidence of any quote). 1 if there are no quotes.
+        reasons: Why each quote got its confidence, for the agreement log.
+    """
+    def __init__(self, lines:list[dict], confidence:float, reasons:list[str]):
+        self.lines = lines
+        self.confidence = confidence
+        self.reasons = reasons
+
+def _lookup_name(who:str, roster:Roster) -> Optional[str]:
+    #Exact (normalized) name, otherwise a single roster name containing one of the words ("Alice" for "Alice Smith").
+    match_key = normalize_name(who)
+    if match_key in roster.match_keys:
+        return roster.match_keys[match_key]
+    for word in match_key.split():
+        candidates = [name for key, name in roster.match_keys.items() if word in key.split()]
+        if len(candidates) == 1:
+            return candidates[0]
+    return None
+
+def _stands_alone(before:str, after:str) -> bool:
+    #Dialog starts a paragraph, a sentence or a clause ('He waved. "Hi."', 'She said, "Hi."'), unlike a quoted phrase
+    #('She called it "the thing".').
+    before, after = before.rstrip(), after.lstrip()
+    return (before == "" or before[-1] in ".!?,:;—–-\"”") and (after == "" or after[0] in ".!?,;—–-\"“" or after[0].isupper())
+
+def _names_someone_else(paragraph:str, roster:Roster) -> bool:
+    narration = QUOTE_REGEX.sub(" ", paragraph)
+    for word in re.findall(r"\b[A-Z][\w'’-]*", narration):
+        if word.lower() not in _NOT_NAMES and _lookup_name(word, roster) is None:
+            return True
+    return False
+
+def parse_quotes(text:str, roster:Roster) -> QuoteExtraction:
+    """
+    Extracts the quoted lines from the text and attributes them to the roster characters, using the usual attribution
+    patterns ("...", said Alice / Alice said, "..." / Alice: "..."). Deterministic, and takes well under a millisecond.
+    Every line gets a confidence, and the extraction is only as confident as its least confident line.
+    """
+    if text.count('"') % 2 != 0 or text.count("“") != text.count("”"):
+        #Quotes spanning paragraphs or stray quote marks, better left to the LLM.
+        return QuoteExtraction([], 0.0, ["unbalanced quotes"])
+    matches = list(QUOTE_REGEX.finditer(text))
+    if len(matches) == 0:
+        return QuoteExtraction([], 1.0, [])
+    if len(roster) == 0:
+        return QuoteExtraction([], 0.0, ["no characters"])
+
+    lines, confidences, reasons = list(), list(), list()
+    previous_speaker = None
+    paragraph_speaker = None
+    consumed = 0    #How much of the text after the previous quote was its attribution
+    for index, match in enumerate(matches):
+        paragraph_start = text.rfind("\n", 0, match.start()) + 1
+        paragraph_end = text.find("\n", match.end())
+        paragraph_end = len(text) if paragraph_end == -1 else paragraph_end
+        if index == 0 or matches[index-1].end() <= paragraph_start:
+            paragraph_speaker = None
+        before_start = max(paragraph_start, matches[index-1].end() if index > 0 else 0)
+        after_end = min(paragraph_end, matches[index+1].start() if index+1 < len(matches) else len(text))
+        before = text[before_start:match.start()]
+        after = text[match.end():after_end]
+        #Whatever is between the previous quote's attribution and this one (an action, a new speaker being named...)
+        between = before[consumed:] if before_start > paragraph_start else before
+        consumed = 0
+
+        after_attribution = _AFTER_VERB_WHO.match(after) or _AFTER_WHO_VERB.match(after)
+        attribution = after_attribution or _BEFORE_WHO_VERB.search(before) or _BEFORE_SCRIPT.match(before)
+        if after_attribution is not None:
+            consumed = after_attribution.end()
+        speaker, confidence, reason = None, GUESS, "no attribution"
+        if attribution is not None:
+            who = attribution.group("who")
+            if who.lower() in _PRONOUN_GENDERS:
+                gender = _PRONOUN_GENDERS[who.lower()]
+                candidates = [name for name in roster.names if gender is not None and roster.voices[name].get("gender") == gender]
+                if len(candidates) == 1 and len(roster) == 1 and (after_attribution is not None or _stands_alone(before, after)):
+                    speaker, confidence, reason = candidates[0], ONLY_CHARACTER, f"pronoun '{who}', only character"
+                elif len(candidates) == 1:
+                    speaker, confidence, reason = candidates[0], PRONOUN, f"pronoun '{who}'"
+                else:
+                    speaker, reason = (previous_speaker if previous_speaker in candidates else None), f"ambiguous pronoun '{who}'"
+            else:
+                speaker = _lookup_name(who, roster)
+                if speaker is not None:
+                    confidence, reason = EXPLICIT, f"attributed to '{who}'"
+                else:
+                    #The LLM is told to skip characters without a voice.
+                    reason = f"attributed to '{who}', who has no voice"
+        elif paragraph_speaker is not None and re.search(r"[A-Z]", between) is None:
+            speaker, confidence, reason = paragraph_speaker, CONTINUATION, "same paragraph as an attributed line"
+        else:
+            paragraph = text[paragraph_start:paragraph_end]
+            mentioned = [name for name in roster.names if re.search(rf"\b{re.escape(name)}\b", paragraph, re.IGNORECASE)]
+            if len(roster) == 1 and not re.search(rf"\b(?i:{_SPEECH_VERBS})\b", before + after) and _stands_alone(before, after) \
+                    and not _names_someone_else(paragraph, roster):
+                speaker, confidence, reason = roster.names[0], ONLY_CHARACTER, "only character"
+            elif len(mentioned) == 1:
+                speaker, confidence, reason = mentioned[0], MENTIONED, f"'{mentioned[0]}' mentioned nearby"
+            else:
+                speaker = previous_speaker if previous_speaker is not None else (mentioned[0] if len(mentioned) > 0 else roster.names[0])
+
+        line = (match.group(1) if match.group(1) is not None else match.group(2)).strip()
+        if speaker is not None:
+            lines.append({"character": speaker, "text": line})
+            if confidence >= CONTINUATION:
+                paragraph_speaker = speaker
+            previous_speaker = speaker
+        confidences.append(confidence)
+        reasons.append(reason)
+
+    return QuoteExtraction(lines, min(confidences), reasons)
+
+def _comparable(lines:list[dict]) -> list[tuple]:
+    #Merges consecutive lines of the same character and drops punctuation/case, since the LLM often joins or trims quotes.
+    merged = list()
+    for line in lines:
+        words = re.findall(r"\w+", str(line.get("text", "")).lower())
+        if len(merged) > 0 and merged[-1][0] == line.get("character"):
+            merged[-1][1].extend(words)
+        else:
+            merged.append((line.get("character"), words))
+    return [(character, tuple(words)) for character, words in merged if len(words) > 0]
+
+class QuoteFastPath:
+    """
+    Decides when the local quote parser is good enough to skip the LLM, and keeps track of how often it agrees with it.
+    Every time both extractions are available (the message went to the LLM anyway, or it was sampled for comparison),
+    the agreement is recorded per confidence bucket, so the threshold can be tuned from the stats.
+    Arguments:
+        threshold: The minimum confidence to skip the LLM. None never skips it (the agreement is still recorded).
+        compare_rate: The fraction of skipped messages that are also sent to the LLM in the background, to compare.
+        log_file: If set, every comparison is appended here as a JSON line.
+    """
+    def __init__(self, threshold:Optional[float]=0.9, compare_rate:float=0.0, log_file:str=None):
+        self.threshold = threshold
+        self.compare_rate = compare_rate
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._stats = {"no_dialog": 0, "fast_path": 0, "llm": 0, "compared": 0, "agreed": 0}
+        self._buckets = dict()  #confidence -> {"compared": int, "agreed": int}
+
+    def accepts(self, extraction:QuoteExtraction) -> bool:
+        if self.threshold is None or extraction.confidence < self.threshold:
+            with self._lock:
+                self._stats["llm"] += 1
+            return False
+        with self._lock:
+            self._stats["no_dialog" if len(extraction.reasons) == 0 else "fast_path"] += 1
+        return True
+
+    def should_compare(self, extraction:QuoteExtraction) -> bool:
+        #Messages with no quotes at all are not worth an LLM call.
+        return len(extraction.reasons) > 0 and random.random() < self.compare_rate
+
+    def record(self, extraction:QuoteExtraction, llm_lines:list[dict]) -> bool:
+        agreed = _comparable(extraction.lines) == _comparable(llm_lines)
+        bucket = f"{extraction.confidence:.1f}"
+        with self._lock:
+            self._stats["compared"] += 1
+            self._stats["agreed"] += int(agreed)
+            counts = self._buckets.setdefault(bucket, {"compared": 0, "agreed": 0})
+            counts["compared"] += 1
+            counts["agreed"] += int(agreed)
+            if self.log_file is not None:
+                entry = {"time": time.time(), "confidence": extraction.confidence, "agreed": agreed, "reasons": extraction.reasons,
+                         "local": extraction.lines, "llm": llm_lines}
+                with open(self.log_file, "a", encoding="utf8") as fp:
+                    fp.write(json.dumps(entry) + "\n")
+        return agreed
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["threshold"] = self.threshold
+            stats["agreement_by_confidence"] = {bucket: dict(counts, rate=round(counts["agreed"] / counts["compared"], 3))
+                                                for bucket, counts in sorted(self._buckets.items())}
+            return stats
@@ -0,0 +1,288 @@
+"""
+Renders messages to audio files instead of playing them, one file per message with the lines in dialog order.
+Uses the same extraction, caches and synthesis as the server.
+
+    python render.py --input messages.jsonl --roster roster.json --output renders
+    python render.py --input messages_dir --roster roster.json --output renders --format mp3 --parallel 8
+
+The input is either a JSONL file with one {"id": ..., "text": ...} per line (the id is optional, the line number is used
+otherwise), or a directory of .txt files (named after the file). The roster is a roster file like the one main.py uses (roster.json,
+or a .toml file), mapping each character name to {"id": voice ID, "gender": gender}.
+
+Progress is saved to progress.jsonl in the output directory, so running the same command again after a crash (or Ctrl+C)
+only renders what's left. Lines that were already generated come from the audio cache, so they aren't paid for twice.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import jobs
+import main
+from pipeline import Player
+from roster_file import RosterFile
+
+class AudioFileWriter:
+    """
+    Writes the lines of a message to a file as they come in, with silence for the gaps, so the whole message
+    is never held in memory. The audio has to be WAV (so the silence can be generated), which is why renders ask for PCM.
+    Arguments:
+        path: The file to write.
+        audio_format: "wav", or "mp3" (encoded by ffmpeg, which the audio is piped to).
+    """
+    def __init__(self, path:str, audio_format:str="wav"):
+        self.path = path
+        self.audio_format = audio_format
+        self.frames = 0
+        self._params = None
+        self._output = None
+
+    def write_audio(self, audio:bytes):
+        if not audio.startswith(b"RIFF"):
+            raise ValueError("Only WAV audio can be rendered to a file, use a PCM output format.")
+        with wave.open(io.BytesIO(audio), "rb") as wav:
+            params = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+            frames = wav.readframes(wav.getnframes())
+        if self._output is None:
+            self._open(params)
+        elif params != self._params:
+            raise ValueError(f"The lines have different audio formats ({self._params} and {params}).")
+        self._write(frames)
+
+    def write_silence(self, seconds:float):
+        if self._output is None:
+            return
+        channels, sample_width, sample_rate = self._params
+        self._write(b"\x00" * (int(seconds * sample_rate) * channels * sample_width))
+
+    @property
+    def empty(self) -> bool:
+        return self._output is None
+
+    def close(self) -> float:
+        #Returns the duration in seconds.
+        if self._output is None:
+            return 0
+        if self.audio_format == "wav":
+            self._output.close()
+        else:
+            self._output.stdin.close()
+            if self._output.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed: {self._output.stderr.read().decode('utf-8', 'replace')}")
+        return self.frames / self._params[2]
+
+    def abort(self):
+        try:
+            if self._output is not None and self.audio_format != "wav":
+                self._output.kill()
+            elif self._output is not None:
+                self._output.close()
+        except Exception:
+            pass
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _open(self, params):
+        self._params = params
+        channels, sample_width, sample_rate = params
+        if self.audio_format == "wav":
+            self._output = wave.open(self.path, "wb")
+            self._output.setnchannels(channels)
+            self._output.setsampwidth(sample_width)
+            self._output.setframerate(sample_rate)
+        else:
+            self._output = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-y", "-f", f"s{sample_width*8}le", "-ar", str(sample_rate),
+                                             "-ac", str(channels), "-i", "-", "-f", self.audio_format, self.path],
+                                            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _write(self, frames:bytes):
+        channels, sample_width, _ = self._params
+        self.frames += len(frames) // (channels * sample_width)
+        if self.audio_format == "wav":
+            self._output.writeframesraw(frames)
+        else:
+            self._output.stdin.write(frames)
+
+class RenderProgress:
+    #The finished messages, appended to a JSONL file as they're done. Only the last entry for each message counts.
+    def __init__(self, path:str):
+        self.path = path
+        self._entries = dict()
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf8") as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    #A line cut short by a crash
+                    self._entries[entry["id"]] = entry
+
+    def done(self, message_id:str, output_dir:str) -> bool:
+        entry = self._entries.get(message_id)
+        if entry is None or entry.get("error") is not None:
+            return False
+        return entry.get("file") is None or os.path.isfile(os.path.join(output_dir, entry["file"]))
+
+    def record(self, entry:dict):
+        with self._lock:
+            self._entries[entry["id"]] = entry
+            with open(self.path, "a", encoding="utf8") as fp:
+                fp.write(json.dumps(entry) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+
+class _Renderer:
+    #One per worker thread: its own Player, which writes to whatever file the worker is currently rendering.
+    def __init__(self):
+        self.writer = None
+        self.error = None
+        self.player = Player(self._play, line_gap=main.line_gap, speaker_change_gap=main.speaker_change_gap, gap_func=self._gap)
+
+    def _play(self, line, audio:bytes):
+        try:
+            self.writer.write_audio(audio)
+        except Exception as e:
+            self.error = self.error or e
+            raise
+
+    def _gap(self, seconds:float):
+        self.writer.write_silence(seconds)
+
+def load_messages(path:str) -> list[tuple[str, str]]:
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) if name.endswith(".txt"))
+        messages = list()
+        for name in names:
+            with open(os.path.join(path, name), "r", encoding="utf8") as fp:
+                messages.append((os.path.splitext(name)[0], fp.read()))
+        return messages
+    messages = list()
+    with open(path, "r", encoding="utf8") as fp:
+        for line_number, line in enumerate(fp, start=1):
+            if line.strip():
+                entry = json.loads(line)
+                messages.append((str(entry.get("id", f"{line_number:06d}")), entry["text"]))
+    return messages
+
+def render_message(renderer:_Renderer, message_id:str, text:str, roster, args, progress:RenderProgress):
+    file_name = re.sub(r"[^\w.-]", "_", message_id) + "." + args.format
+    path = os.path.join(args.output, file_name)
+    writer = AudioFileWriter(path + ".part", args.format)
+    renderer.writer = writer
+    renderer.error = None
+    start = time.perf_counter()
+    job = jobs.Job(text, roster)
+    try:
+        main.process_job(job, renderer.player)
+        if renderer.error is not None:
+            raise renderer.error
+        duration = writer.close()
+    except Exception as e:
+        traceback.print_exc()
+        writer.abort()
+        progress.record({"id": message_id, "error": f"{type(e).__name__}: {e}"})
+        return False
+    if writer.empty:
+        file_name = None
+    else:
+        os.replace(path + ".part", path)
+    lines = sum(1 for span in job.spans if span["span"] == "playback")
+    progress.record({"id": message_id, "file": file_name, "lines": lines, "method": job.extraction.get("method"),
+                     "duration": round(duration, 3), "render_seconds": round(time.perf_counter() - start, 3)})
+    return True
+
+def start_backends(args):
+    from backends import LocalQuoteExtractor, NullSink, ToneSynthesizer
+    if args.local:
+        main.start_services(LocalQuoteExtractor(), ToneSynthesizer(), NullSink())
+        return
+    import httpx
+    import openai
+    from elevenlabslib import User, GenerationOptions
+    from api_clients import ProviderClient
+    from backends import OpenAIExtractor, ElevenLabsSynthesizer
+    openai_api_key = main.get_saved_key("openai_api_key", "OPENAI_API_KEY")
+    elevenlabs_api_key = main.get_saved_key("elevenlabs_api_key", "ELEVENLABS_API_KEY")
+    elevenlabs_model = main.get_saved_key("elevenlabs_model", "ELEVENLABS_MODEL") or "eleven_multilingual_v2"
+    if openai_api_key is None or elevenlabs_api_key is None:
+        sys.exit("No API keys found. Run main.py once to save them, or set OPENAI_API_KEY and ELEVENLABS_API_KEY.")
+
+    openai_client = openai.Client(api_key=openai_api_key, max_retries=0,
+                                  http_client=openai.DefaultHttpxClient(limits=httpx.Limits(max_connections=main.openai_max_concurrent*2, max_keepalive_connections=main.openai_max_concurrent)))
+    # Renders ask for PCM (returned as WAV), so the lines can be joined with silence in between.
+    generation_options = GenerationOptions(model_id=elevenlabs_model, output_format=f"pcm_{args.sample_rate}")
+    main.api_providers["openai"] = ProviderClient("openai", max_concurrent=main.openai_max_concurrent, pool_size=main.openai_max_concurrent, max_attempts=main.api_max_attempts)
+    main.api_providers["elevenlabs"] = ProviderClient("elevenlabs", max_concurrent=main.elevenlabs_max_concurrent, pool_size=main.elevenlabs_max_concurrent*2, max_attempts=main.api_max_attempts)
+    main.start_services(OpenAIExtractor(openai_client, main.extraction_model, main.api_providers["openai"]),
+                        ElevenLabsSynthesizer(User(elevenlabs_api_key), generation_options, main.api_providers["elevenlabs"]), NullSink())
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="A JSONL file of messages, or a directory of .txt files.")
+    parser.add_argument("--roster", required=True, help="The roster file, as used by main.py (JSON, or TOML if it ends in .toml).")
+    parser.add_argument("--output", required=True, help="The directory the audio files (and progress.jsonl) are written to.")
+    parser.add_argument("--format", choices=["wav", "mp3", "ogg", "flac"], default="wav", help="Anything but wav needs ffmpeg.")
+    parser.add_argument("--parallel", type=int, default=4, help="How many messages are rendered at the same time.")
+    parser.add_argument("--sample-rate", type=int, default=24000, choices=[16000, 22050, 24000, 44100])
+    parser.add_argument("--line-gap", type=float, default=None, help="Seconds of silence between lines (line_gap in main.py by default).")
+    parser.add_argument("--local", action="store_true", help="Use the offline extractor and tone synthesizer (for testing).")
+    args = parser.parse_args()
+
+    if args.format != "wav" and shutil.which("ffmpeg") is None:
+        sys.exit(f"Rendering to {args.format} needs ffmpeg on the PATH.")
+    if args.line_gap is not None:
+        main.line_gap = main.speaker_change_gap = args.line_gap
+    if not os.path.isfile(args.roster):
+        sys.exit(f"The roster {args.roster} doesn't exist.")
+    try:
+        voice_dict = RosterFile(args.roster, main.roster_holder).read()
+    except (OSError, ValueError) as e:
+        sys.exit(f"Could not load the roster from {args.roster}: {e}")
+    messages = load_messages(args.input)
+    os.makedirs(args.output, exist_ok=True)
+    progress = RenderProgress(os.path.join(args.output, "progress.jsonl"))
+    pending = [(message_id, text) for message_id, text in messages if not progress.done(message_id, args.output)]
+    print(f"{len(messages)} messages, {len(messages) - len(pending)} already rendered.")
+    if len(pending) == 0:
+        return
+    start_backends(args)
+    roster = main.roster_holder.publish(voice_dict)
+
+    renderers = threading.local()
+    counts = {"done": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def task(message):
+        if not hasattr(renderers, "renderer"):
+            renderers.renderer = _Renderer()
+        succeeded = render_message(renderers.renderer, message[0], message[1], roster, args, progress)
+        with counts_lock:
+            counts["done" if succeeded else "failed"] += 1
+            finished = counts["done"] + counts["failed"]
+        if finished % 10 == 0 or finished == len(pending):
+            print(f"{finished}/{len(pending)} rendered ({counts['failed']} failed).", flush=True)
+
+    executor = ThreadPoolExecutor(max_workers=args.parallel)
+    try:
+        for future in [executor.submit(task, message) for message in pending]:
+            future.result()
+    except KeyboardInterrupt:
+        print("Stopping, run the same command again to continue.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        os._exit(1)
+    executor.shutdown()
+    if counts["failed"] > 0:
+        print(f"{counts['failed']} messages failed, run the same command again to retry them.")
+
+if __name__ == "__main__":
+    main_cli()
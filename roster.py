@@ -0,0 +1,147 @@
+import difflib
+import hashlib
+import itertools
+import json
+import threading
+from collections import Counter
+from types import MappingProxyType
+from typing import Callable
+
+SYSTEM_PROMPT = ("Your job is to act as a dialog speaker. You will extract the quoted"
+                 "(in quotes) dialog from the provided input and speak it using the provided function."
+                 "\nYou must NOT modify the text, only extract the dialog."
+                 "\nIf a character does not has an associated voice, ignore it.")
+
+def normalize_name(name:str) -> str:
+    return " ".join(name.lower().split())
+
+def _trigrams(name:str) -> set[str]:
+    padded = f"  {name} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+class Roster:
+    """
+    An immutable snapshot of the characters and their voices.
+    Everything that only depends on the characters (the tool schema, the prompt, the name lookup) is computed once here,
+    instead of on every request.
+    Arguments:
+        voice_dict: Character name -> {"id": voice ID, "gender": gender}
+        version: Increases every time a new roster is published.
+    """
+    def __init__(self, voice_dict:dict, version:int=0):
+        self.version = version
+        self.voices = MappingProxyType({name: MappingProxyType(dict(data)) for name, data in voice_dict.items()})
+        self.names = tuple(self.voices.keys())
+        self.match_keys = MappingProxyType({normalize_name(name): name for name in self.names})
+        self._trigram_index = dict()
+        for match_key in self.match_keys:
+            for trigram in _trigrams(match_key):
+                self._trigram_index.setdefault(trigram, []).append(match_key)
+        self._resolved = dict()
+        self.tools = self._build_tools()
+        self.system_prompt = SYSTEM_PROMPT
+        self.instructions = "Please speak the dialog from the previous message.\nThe characters you can choose from are:\n"
+        for character_name, data in self.voices.items():
+            self.instructions += f"- '{character_name}' (Gender: {data.get('gender')})\n"
+        #Identifies the names and genders (the only things the extraction depends on).
+        self.fingerprint = hashlib.sha256(json.dumps(sorted((name, data.get("gender")) for name, data in self.voices.items())).encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return len(self.voices)
+
+    def resolve(self, character:str) -> str | None:
+        """
+        Returns the roster name that best matches the given character name.
+        Exact and normalized names are a dictionary lookup. Anything else goes through the trigram index,
+        and only the names sharing the most trigrams are compared in full. Results are memoized (the roster never changes).
+        """
+        if character in self.voices:
+            return character
+        if character in self._resolved:
+            return self._resolved[character]
+
+        match_key = normalize_name(character)
+        name = self.match_keys.get(match_key)
+        if name is None and len(self.names) > 0:
+            name = self._fuzzy_match(match_key)
+        self._resolved[character] = name
+        return name
+
+    def _fuzzy_match(self, match_key:str, candidate_count:int=10) -> str:
+        shared = Counter()
+        for trigram in _trigrams(match_key):
+            shared.update(self._trigram_index.get(trigram, ()))
+        if len(shared) > 0:
+            candidates = [candidate for candidate, _ in shared.most_common(candidate_count)]
+        else:
+            candidates = list(self.match_keys)
+        best = max(candidates, key=lambda candidate: difflib.SequenceMatcher(None, match_key, candidate).ratio())
+        return self.match_keys[best]
+
+    def to_dict(self) -> dict:
+        return {name: dict(data) for name, data in self.voices.items()}
+
+    def build_messages(self, text:str) -> list[dict]:
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": text},
+            {"role": "user", "content": self.instructions}
+        ]
+
+    def _build_tools(self) -> list:
+        return [
+            {
+                "type": "function",
+                "function": {
+                    "name": "speak",
+                        "description": "Speaks the given prompt as a chosen character.",
+                        "parameters": {
+                            "type": "object",
+                            "properties": {
+                                "speech_data": {
+                                    "type": "array",
+                                    "items" : {
+                                        "type": "object",
+                                        "properties": {
+                                            "character": {
+                                                "type": 'string',
+                                                "enum": list(self.names),
+                                                "description": 'The name of the character speaking the line.'
+                                            },
+                                            "text": {
+                                                "type": 'string',
+                                                "description": 'The line the character should speak.'
+                                            }
+                                        }
+                                    }
+                                }
+                            },
+                            "required": ["speech_data"]
+                        }
+                }
+            }
+        ]
+
+class RosterHolder:
+    """
+    Holds the current Roster. Publishing a new one just swaps the reference, so readers never need a lock.
+    """
+    def __init__(self):
+        self._versions = itertools.count(1)
+        self._publish_lock = threading.Lock()
+        self._listeners = list()
+        self.current = Roster(dict())
+
+    def publish(self, voice_dict:dict) -> Roster:
+        with self._publish_lock:
+            if voice_dict == self.current.to_dict():
+                return self.current
+            roster = Roster(voice_dict, next(self._versions))
+            self.current = roster
+        for listener in self._listeners:
+            listener(roster)
+        return roster
+
+    def add_listener(self, listener:Callable[[Roster], None]):
+        #The listener is called with every new roster.
+        self._listeners.append(listener)
@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+
+from roster import RosterHolder
+
+class RosterFile:
+    """
+    The characters and their voices, kept in a file so they can be used without the GUI.
+    Every change to the file is published to the RosterHolder, and the GUI saves to it whenever a picker changes.
+    The file maps each character name to its voice, either as JSON:
+        {"Alice": {"id": "<voice ID>", "gender": "female"}}
+    or as TOML (if the file name ends in .toml):
+        ["Alice"]
+        id = "<voice ID>"
+        gender = "female"
+    Arguments:
+        path: The roster file. It's created (empty) if missing.
+        holder: Where the roster is published.
+        check_interval: Seconds between checks for changes to the file, once watch() is called.
+    """
+    def __init__(self, path:str, holder:RosterHolder, check_interval:float=1.0):
+        self.path = path
+        self.holder = holder
+        self.check_interval = check_interval
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if not os.path.isfile(path):
+            self.save(dict())
+
+    def load(self) -> bool:
+        #Publishes the roster in the file. If the file can't be read, the current roster is kept.
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            print(f"Could not load the roster from {self.path}, keeping the current one: {e}")
+            return False
+        with self._lock:
+            self._mtime = mtime  #Even if it's invalid, so it's only reported once per change
+        try:
+            voice_dict = self.read()
+        except (OSError, ValueError) as e:
+            print(f"Could not load the roster from {self.path}, keeping the current one: {e}")
+            return False
+        roster = self.holder.publish(voice_dict)
+        print(f"Loaded {len(roster)} characters from {self.path}.")
+        return True
+
+    def read(self) -> dict:
+        #Parses the file without publishing it. Raises OSError or ValueError if it can't be read.
+        if self.path.endswith(".toml"):
+            import tomllib
+            with open(self.path, "rb") as fp:
+                data = tomllib.load(fp)
+        else:
+            with open(self.path, "r", encoding="utf8") as fp:
+                data = json.load(fp)
+        return _validate(data)
+
+    def save(self, voice_dict:dict):
+        #Writes the roster (atomically, so a reload never sees half a file) and publishes it.
+        temp_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(temp_path, "w", encoding="utf8") as fp:
+                if self.path.endswith(".toml"):
+                    fp.write(_to_toml(voice_dict))
+                else:
+                    json.dump(voice_dict, fp, indent=4)
+            os.replace(temp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        self.holder.publish(voice_dict)
+
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        with self._lock:
+            changed = mtime != self._mtime
+        return changed and self.load()
+
+    def watch(self) -> threading.Thread:
+        #Loads the file, then reloads it in the background whenever it changes.
+        self.load()
+        thread = threading.Thread(target=self._watch_loop, daemon=True, name="roster-file")
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def _watch_loop(self):
+        while not self._stopped.wait(self.check_interval):
+            self.reload_if_changed()
+
+def _validate(data) -> dict:
+    if not isinstance(data, dict):
+        raise ValueError("The roster must map character names to {\"id\": voice ID, \"gender\": gender}.")
+    voice_dict = dict()
+    for name, entry in data.items():
+        if isinstance(entry, str):
+            entry = {"id": entry}   #Just the voice ID
+        if not isinstance(entry, dict):
+            raise ValueError(f"Invalid roster entry for '{name}'.")
+        voice_dict[str(name)] = {"gender": entry.get("gender", "other"), "id": entry.get("id")}
+    return voice_dict
+
+def _to_toml(voice_dict:dict) -> str:
+    tables = list()
+    for name, entry in voice_dict.items():
+        table = [f"[{_toml_string(name)}]"]
+        for key in ("id", "gender"):
+            if entry.get(key) is not None:
+                table.append(f"{key} = {_toml_string(entry[key])}")
+        tables.append("\n".join(table))
+    return "\n\n".join(tables) + "\n"
+
+def _toml_string(value) -> str:
+    #JSON strings are valid TOML strings, which covers the escaping. Except that TOML rejects the \uXXXX surrogate pairs
+    #json uses for characters like emoji (hence ensure_ascii=False) and a raw DEL character.
+    return json.dumps(str(value), ensure_ascii=False).replace("\x7f", "\\u007f")
@@ -9,6 +9,8 @@
 // @match		https://www.perplexity.ai/*
 // @match		https://www.claude.ai/*
 // @grant       GM_xmlhttpRequest
+// @connect     localhost
+// @connect     *
 // @version     1.0
 // @author      lugia19
 // @description 25/12/2023, 11:39:59
@@ -17,6 +19,13 @@
 
 
 const flask_port = 57319
+// Set to true to play the audio in the browser (streamed from the server as it's generated) instead of on the machine running main.py.
+// Also set flask_host if the server is on another machine.
+const client_playback = false
+const flask_host = "localhost"
+// Set to true to send every new message to the server as soon as it's done, so it's ready before you click the button.
+// The server has an hourly limit on how much it generates this way (prefetch_chars_per_hour in main.py).
+const prefetch_messages = false
 
 let message_classes = []
 if (window.top !== window.self)
@@ -60,13 +69,60 @@ function findChildWithSelector(element, selector) {
     return null;
 }
 
+// The element whose text is spoken. Prefetching has to send the exact same text as the button does.
+function get_message_text_element(inner_message) {
+	if (isClaude || isPerplexity)
+		return inner_message
+	return findChildWithSelector(inner_message, ".markdown")
+}
+
+// A message counts as done once its text stopped changing between two checks.
+// Messages that were already on the page when it loaded are never prefetched.
+let message_states = new WeakMap()
+let first_scan = true
+function prefetch_finished_messages(assistant_messages) {
+	for (let message of assistant_messages) {
+		let text_element = get_message_text_element(message)
+		let text = text_element ? text_element.textContent : ""
+		let state = message_states.get(message)
+		if (!state) {
+			message_states.set(message, {text: text, sent: first_scan})
+		} else if (!state.sent && text && text === state.text) {
+			state.sent = true
+			GM_xmlhttpRequest({
+				method: 'POST',
+				url: `http://${flask_host}:${flask_port}/prefetch`,
+				headers: {
+					'Content-Type': 'application/json'
+				},
+				data: JSON.stringify({
+					text: text
+				}),
+				onload: function(response) {
+					console.log('Prefetch:', response.responseText)
+				},
+				onerror: function(response) {
+					console.error('Prefetch failed', response);
+				}
+			});
+		} else {
+			state.text = text
+		}
+	}
+	first_scan = false
+}
+
 function handleButtonClick(event, markdownChild) {
 	console.log('Button was clicked!');
 	if (markdownChild) {
 		let textContent = markdownChild.textContent;
 		console.log(textContent);
 
-		let apiEndpoint = `http://localhost:${flask_port}/generate_extract_audio`;
+		let apiEndpoint = `http://${flask_host}:${flask_port}/generate_extract_audio`;
+		if (client_playback) {
+			stream_audio(apiEndpoint, textContent)
+			return
+		}
 		// Prepare the data to send
 		let dataToSend = JSON.stringify({
 		  text: textContent
@@ -84,8 +140,12 @@ function handleButtonClick(event, markdownChild) {
 			// The request was successful
 			if (response.status >= 200 && response.status < 300) {
 			  // Assuming the response is JSON; parse and log or process it
+			  // The server answers right away with a job ID, the audio is generated and played in the background
 			  let data = JSON.parse(response.responseText);
 			  console.log('Success:', data);
+			  if (data.job_id) {
+				console.log(`Speech job ${data.job_id} queued, status at http://${flask_host}:${flask_port}${data.status_url}`);
+			  }
 			} else {
 			  // Handle HTTP error responses
 			  throw new Error('Request was not successful: ' + response.status);
@@ -100,6 +160,84 @@ function handleButtonClick(event, markdownChild) {
 	}
 }
 
+// Plays the lines streamed back by the server, in order and with the gaps it asks for.
+// The AudioContext is created on the click, so the browser lets it play even though the audio arrives later.
+class StreamPlayer {
+	constructor() {
+		this.context = new AudioContext()
+		this.next_start = 0
+		this.decoding = Promise.resolve()
+	}
+
+	add_line(event) {
+		let bytes = Uint8Array.from(atob(event.audio), c => c.charCodeAt(0))
+		// Decoding is async, chaining keeps the lines in order.
+		this.decoding = this.decoding.then(() => this.context.decodeAudioData(bytes.buffer)).then(buffer => {
+			let source = this.context.createBufferSource()
+			source.buffer = buffer
+			source.connect(this.context.destination)
+			let start = Math.max(this.context.currentTime, this.next_start + event.gap)
+			source.start(start)
+			this.next_start = start + buffer.duration
+			console.log(`${event.character}: ${event.text}`)
+		}).catch(error => console.error('Could not play line', event.index, error))
+	}
+}
+
+function stream_audio(apiEndpoint, textContent) {
+	let player = new StreamPlayer()
+	let parsed_length = 0
+	// The response is one JSON object per line, handle every complete line as soon as it comes in.
+	function handle_new_lines(responseText) {
+		let end = responseText.lastIndexOf('\n')
+		if (end < parsed_length)
+			return
+		let lines = responseText.substring(parsed_length, end).split('\n')
+		parsed_length = end + 1
+		for (let line of lines) {
+			if (!line.trim())
+				continue
+			let event = JSON.parse(line)
+			if (event.type === 'line') {
+				player.add_line(event)
+			} else if (event.type === 'job') {
+				console.log(`Speech job ${event.job_id} streaming, status at http://${flask_host}:${flask_port}${event.status_url}`)
+			} else if (event.type === 'done') {
+				console.log(`Speech job ${event.job_id} ${event.state}:`, event.message || event.error)
+			} else if (event.type !== 'ping') {
+				// Not streamed (no voices, shutting down...)
+				console.log('Response:', event)
+			}
+		}
+	}
+
+	GM_xmlhttpRequest({
+		method: 'POST',
+		url: apiEndpoint,
+		headers: {
+			'Content-Type': 'application/json'
+		},
+		data: JSON.stringify({
+			text: textContent,
+			playback: 'client'
+		}),
+		onprogress: function(response) {
+			if (response.responseText)
+				handle_new_lines(response.responseText)
+		},
+		onload: function(response) {
+			if (response.status >= 200 && response.status < 300) {
+				handle_new_lines(response.responseText + '\n')
+			} else {
+				console.error('Request was not successful: ' + response.status, response.responseText)
+			}
+		},
+		onerror: function(response) {
+			console.error('Request failed', response);
+		}
+	});
+}
+
 //This function gets all the messages, and adds speaker buttons to them (with the relevant events)
 function get_assistant_messages_cgpt() {
 	// Use document.querySelectorAll() to get all elements matching the selector
@@ -152,7 +290,7 @@ function add_speaker_button_cgpt(inner_message) {
 		// Set the ID for the new button
 		newButton.id = speaker_button_id;
 		newButton.addEventListener('click', function (event) {
-			handleButtonClick(event, findChildWithSelector(inner_message, ".markdown"));
+			handleButtonClick(event, get_message_text_element(inner_message));
 		});
 		buttons_div.prepend(newButton);
 	}
@@ -183,7 +321,7 @@ function add_speaker_button_gemini(inner_message) {
 		// Set the ID for the new button
 		newButton.id = speaker_button_id;
 		newButton.addEventListener('click', function (event) {
-			handleButtonClick(event, findChildWithSelector(inner_message, ".markdown"));
+			handleButtonClick(event, get_message_text_element(inner_message));
 		});
 		buttons_div.append(newButton);
 	}
@@ -217,7 +355,7 @@ function add_speaker_button_claude(inner_message) {
 			newButton.id = speaker_button_id;
 			newButton.title = "Text to speech";
 			newButton.addEventListener('click', function (event) {
-				handleButtonClick(event, inner_message);
+				handleButtonClick(event, get_message_text_element(inner_message));
 			});
 
 			// Insert the new button after the first button in the div
@@ -261,7 +399,7 @@ function add_speaker_button_perplexity(inner_message) {
         </div>
     `;
     newButton.addEventListener('click', function (event) {
-        handleButtonClick(event, inner_message);
+        handleButtonClick(event, get_message_text_element(inner_message));
     });
 
     // Insert the new button as the first child of the bottom right button group
@@ -275,6 +413,8 @@ function add_all_speaker_buttons() {
 		console.log("Adding speaker button...")
 		add_speaker_button(assistant_message)
 	}
+	if (prefetch_messages)
+		prefetch_finished_messages(assistant_messages)
 }
 
 setInterval(add_all_speaker_buttons, 3 * 1000)
\ No newline at end of file
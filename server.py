@@ -0,0 +1,60 @@
+import threading
+import time
+from typing import Callable, Optional
+
+class SpeakerServer:
+    """
+    Serves the Flask app with waitress instead of the Flask development server.
+    Requests are handled by a pool of worker threads, connections are kept alive, and request bodies are size limited.
+    Arguments:
+        app: The WSGI app.
+        host, port: Where to listen. Port 0 picks a free one (see the port attribute).
+        threads: Size of the request handling thread pool.
+        max_request_bytes: Requests with a bigger body are rejected.
+        connection_limit: Maximum number of open connections.
+        keepalive_timeout: Seconds an idle kept-alive connection stays open.
+    """
+    def __init__(self, app, host:str="127.0.0.1", port:int=57319, threads:int=8, max_request_bytes:int=1024*1024,
+                 connection_limit:int=100, keepalive_timeout:int=60):
+        from waitress.server import create_server
+        self._server = create_server(app, host=host, port=port, threads=threads, max_request_body_size=max_request_bytes,
+                                     connection_limit=connection_limit, channel_timeout=keepalive_timeout, ident="GPT_Speaker")
+        self.port = self._server.effective_port
+        self._thread:Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self._run, daemon=True, name="http-server")
+        self._thread.start()
+        return self._thread
+
+    def _run(self):
+        try:
+            self._server.run()
+        except OSError:
+            #Raised by the loop when the sockets get closed under it during shutdown.
+            if not self._stopped.is_set():
+                raise
+
+    def stop(self, drain:Callable[[float], bool]=None, timeout:float=30):
+        """
+        Stops the server. If drain is given, it's called first with the timeout, and should block until
+        the in-flight work is done (returning False if it timed out). Requests are still answered while draining,
+        so clients can keep polling their jobs.
+        """
+        if self._stopped.is_set():
+            return
+        start = time.monotonic()
+        if drain is not None and not drain(timeout):
+            print("Timed out waiting for the in-flight jobs, stopping anyway.")
+        self._stopped.set()
+        #Closing every socket (listener, open connections and the trigger itself) from inside the loop makes it exit.
+        server_map = self._server._map
+        self._server.trigger.pull_trigger(lambda: [dispatcher.close() for dispatcher in list(server_map.values())])
+        self._server.task_dispatcher.shutdown()
+        if self._thread is not None:
+            self._thread.join(max(1.0, timeout - (time.monotonic() - start)))
+
+    def wait(self):
+        #Blocks until stop() has been called.
+        self._stopped.wait()
@@ -0,0 +1,40 @@
+import threading
+import time
+
+class StartupProfile:
+    """
+    Times the startup stages (imports, login, services, UI) for --profile-startup.
+    Arguments:
+        enabled: Whether to print anything. Marking is cheap, so it's always done.
+    """
+    def __init__(self, enabled:bool=False):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.stages = list()    #(stage, seconds, counted in the total)
+        self._last = self.start
+        self._lock = threading.Lock()
+
+    def mark(self, stage:str, waiting:bool=False):
+        #Records the time since the previous mark. Waiting stages (dialogs) are shown but left out of the total.
+        with self._lock:
+            now = time.perf_counter()
+            self.stages.append((stage, now - self._last, not waiting))
+            self._last = now
+
+    def mark_background(self, stage:str):
+        #For work running alongside startup: records when it finished, since launch.
+        with self._lock:
+            elapsed = time.perf_counter() - self.start
+        if self.enabled:
+            print(f"[startup] {stage} finished in the background at {elapsed*1000:.0f} ms")
+
+    def report(self, title:str):
+        if not self.enabled:
+            return
+        with self._lock:
+            stages = list(self.stages)
+        width = max(len(stage) for stage, _, _ in stages) if len(stages) > 0 else 0
+        print(f"[startup] {title}:")
+        for stage, seconds, counted in stages:
+            print(f"[startup]   {stage:<{width}}  {seconds*1000:8.1f} ms{'' if counted else '  (waiting, not counted)'}")
+        print(f"[startup]   {'total':<{width}}  {sum(seconds for _, seconds, counted in stages if counted)*1000:8.1f} ms")
@@ -0,0 +1,107 @@
+import json
+import os
+import re
+import threading
+import time
+
+class TextChanges:
+    """
+    Applies the replacements from text_changes.json in a single pass.
+    All the keys are compiled into one regex (built from a trie, so it stays fast with thousands of entries).
+    When several keys match at the same position the longest one wins, and replaced text is never replaced again.
+    The file is reloaded automatically when it changes on disk.
+    Arguments:
+        path: The JSON file with the replacements. It's created (empty) if missing.
+        whole_words: Only replace keys that aren't part of a longer word.
+        ignore_case: Match the keys regardless of case.
+        check_interval: Minimum number of seconds between checks for changes to the file.
+    """
+    def __init__(self, path:str, whole_words:bool=False, ignore_case:bool=False, check_interval:float=1.0):
+        self.path = path
+        self.whole_words = whole_words
+        self.ignore_case = ignore_case
+        self.check_interval = check_interval
+        self.changes = dict()
+        self._lookup = dict()
+        self._regex = None
+        self._mtime = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        if not os.path.isfile(path):
+            with open(path, "w", encoding="utf8") as fp:
+                json.dump(self.changes, fp)
+        self._reload_if_changed(force=True)
+
+    def apply(self, text:str) -> str:
+        self._reload_if_changed()
+        regex, lookup = self._regex, self._lookup
+        if regex is None:
+            return text
+        if self.ignore_case:
+            #re.IGNORECASE doesn't fold every character the way str.lower() does ("İ".lower() is two characters), so a match
+            #might not be in the lookup. It's left as it is.
+            return regex.sub(lambda match: lookup.get(match.group(0).lower(), match.group(0)), text)
+        return regex.sub(lambda match: lookup[match.group(0)], text)
+
+    def set_changes(self, changes:dict):
+        #Compiles the given replacements, without touching the file.
+        lookup = dict()
+        for key, value in changes.items():
+            if key == "":
+                continue
+            lookup_key = key.lower() if self.ignore_case else key
+            if lookup_key not in lookup:
+                lookup[lookup_key] = str(value)
+        regex = None
+        if len(lookup) > 0:
+            pattern = _trie_pattern(_build_trie(lookup.keys()))
+            if self.whole_words:
+                pattern = rf"(?<!\w){pattern}(?!\w)"
+            regex = re.compile(pattern, re.IGNORECASE if self.ignore_case else 0)
+        with self._lock:
+            self.changes = dict(changes)
+            self._lookup = lookup
+            self._regex = regex
+
+    def _reload_if_changed(self, force:bool=False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime and not force:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, "r", encoding="utf8") as fp:
+                changes = json.load(fp)
+        except (OSError, ValueError) as e:
+            print(f"Could not load {self.path}, keeping the previous text changes: {e}")
+            return
+        self.set_changes(changes)
+        print(f"Loaded {len(self._lookup)} text changes.")
+
+def _build_trie(keys) -> dict:
+    trie = dict()
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, dict())
+        node[""] = True     #Marks the end of a key.
+    return trie
+
+def _trie_pattern(node:dict) -> str:
+    #Longer matches are tried first, since the end of a key is only accepted if nothing longer matches.
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in node.items() if char != ""]
+    if len(branches) == 0:
+        return ""
+    is_end = "" in node
+    if len(branches) == 1 and not is_end:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    if is_end:
+        pattern += "?"
+    return pattern